@@ -1,17 +1,103 @@
 import json
 import os
-
-from bbox import BoundingBox
+import threading
+
+import numpy as np
+
+from bbox import BoundingBox, SRC_KEYFRAME, SRC_INTERPOLATED
+from interval_index import IntervalIndex
+from journal import AnnotationJournal, read_journal
+
+# src of a frame without a bounding box
+SRC_NONE = 255
+
+# tubes may be decoded lazily from the GUI and the export threads
+_load_lock = threading.Lock()
+
+
+def _pchip_slopes(h, delta):
+    """slopes of a monotone piecewise cubic (Fritsch-Carlson), which does
+    not overshoot between keyframes
+    """
+    slopes = np.zeros((h.shape[0] + 1, delta.shape[1]))
+    if h.shape[0] == 1:
+        slopes[:] = delta[0]
+        return slopes
+    w1 = 2 * h[1:] + h[:-1]
+    w2 = h[1:] + 2 * h[:-1]
+    same_sign = delta[:-1] * delta[1:] > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        harmonic = (w1 / delta[:-1] + w2 / delta[1:]) / (w1 + w2)
+        slopes[1:-1] = np.where(same_sign, 1 / harmonic, 0)
+    for i, j, k in ((0, 0, 1), (-1, -1, -2)):
+        slope = ((2 * h[j] + h[k]) * delta[j] - h[j] * delta[k]) / (
+            h[j] + h[k])
+        slope[np.sign(slope) != np.sign(delta[j])] = 0
+        too_steep = ((np.sign(delta[j]) != np.sign(delta[k])) &
+                     (np.abs(slope) > 3 * np.abs(delta[j])))
+        slope[too_steep] = 3 * delta[j][too_steep]
+        slopes[i] = slope
+    return slopes
+
+
+def interpolate_rects(frames, key_frames, key_rects, mode='linear'):
+    """interpolate (x, y, w, h) at frames from the rects of sorted keyframes
+
+    mode is 'linear' or 'cubic' (monotone cubic), frames outside the range
+    of the keyframes are clamped to the first or last keyframe
+    """
+    frames = np.asarray(frames, dtype=np.float64)
+    key_frames = np.asarray(key_frames, dtype=np.float64)
+    key_rects = np.asarray(key_rects, dtype=np.float64)
+    if key_frames.shape[0] == 1:
+        return np.repeat(key_rects, frames.shape[0], axis=0)
+    frames = np.clip(frames, key_frames[0], key_frames[-1])
+    idx = np.clip(np.searchsorted(key_frames, frames, side='right') - 1,
+                  0, key_frames.shape[0] - 2)
+    h = np.diff(key_frames)[:, None]
+    delta = np.diff(key_rects, axis=0) / h
+    t = (frames - key_frames[idx])[:, None]
+    if mode == 'linear':
+        return key_rects[idx] + delta[idx] * t
+    elif mode == 'cubic':
+        slopes = _pchip_slopes(h, delta)
+        hi = h[idx]
+        s = t / hi
+        return (key_rects[idx] * (1 + 2 * s) * (1 - s) ** 2 +
+                slopes[idx] * hi * s * (1 - s) ** 2 +
+                key_rects[idx + 1] * s ** 2 * (3 - 2 * s) +
+                slopes[idx + 1] * hi * s ** 2 * (s - 1))
+    else:
+        raise ValueError('unknown interpolation mode: {}'.format(mode))
 
 
 class Tube(object):
+    """a tube stores its bounding boxes in columnar arrays
+
+    `rects` holds the (x, y, w, h) of every frame from `start` as int32 and
+    `srcs` the corresponding src as uint8 (SRC_NONE for empty frames), the
+    label is kept once per tube. `get_bbox` builds a BoundingBox on demand.
+    The arrays of a tube read from a binary file are only decoded by
+    `loader` when they are first used.
+    """
 
     def __init__(self, id, label, start, end=None, bboxes=None):
         self._id = id
         self._label = label
         self._start = start
         self._end = start if end is None else end
-        self.bboxes = bboxes if bboxes is not None else []
+        self._rects = np.zeros((0, 4), dtype=np.int32)
+        self._srcs = np.zeros(0, dtype=np.uint8)
+        self._len = 0
+        self._loader = None
+        if bboxes is not None:
+            for i, bbox in enumerate(bboxes):
+                if bbox:
+                    self.set_bbox(start + i, bbox)
+
+    def __len__(self):
+        self._load()
+        return self._len
 
     @property
     def id(self):
@@ -40,91 +126,311 @@ class Tube(object):
             raise ValueError('end must be greater than or equal to start')
         self._end = end
 
+    @property
+    def rects(self):
+        self._load()
+        return self._rects[:self._len]
+
+    @property
+    def srcs(self):
+        self._load()
+        return self._srcs[:self._len]
+
+    @property
+    def bboxes(self):
+        self._load()
+        return [self.get_bbox(self._start + i) for i in range(self._len)]
+
+    @property
+    def nbytes(self):
+        self._load()
+        return self._rects.nbytes + self._srcs.nbytes
+
+    @property
+    def loaded(self):
+        return self._loader is None
+
+    def set_loader(self, loader):
+        """loader(tube) is called once to fill the arrays by set_arrays"""
+        self._loader = loader
+
+    def set_arrays(self, rects, srcs):
+        self._rects = rects
+        self._srcs = srcs
+        self._len = srcs.shape[0]
+
+    def _load(self):
+        if self._loader is not None:
+            with _load_lock:
+                if self._loader is not None:
+                    self._loader(self)
+                    self._loader = None
+
+    def _reserve(self, length):
+        """grow the arrays geometrically so that appending is amortized O(1)
+        and mark the new frames as empty
+        """
+        self._load()
+        if length > self._rects.shape[0]:
+            capacity = max(length, 2 * self._rects.shape[0], 16)
+            rects = np.zeros((capacity, 4), dtype=np.int32)
+            srcs = np.full(capacity, SRC_NONE, dtype=np.uint8)
+            rects[:self._len] = self._rects[:self._len]
+            srcs[:self._len] = self._srcs[:self._len]
+            self._rects = rects
+            self._srcs = srcs
+        if length > self._len:
+            self._srcs[self._len:length] = SRC_NONE
+            self._len = length
+
     def set_bbox(self, frame_id, bbox):
-        while len(self.bboxes) < frame_id - self._start + 1:
-            self.bboxes.append([])
-        self.bboxes[frame_id - self._start] = bbox
+        idx = frame_id - self._start
+        self._reserve(idx + 1)
+        self._rects[idx] = list(bbox)
+        self._srcs[idx] = bbox.src
         if self._end < frame_id:
             self._end = frame_id
 
     def get_bbox(self, frame_id):
-        if frame_id >= self._start and frame_id <= self._end:
-            return self.bboxes[frame_id - self._start]
+        self._load()
+        idx = frame_id - self._start
+        if (frame_id <= self._end and 0 <= idx < self._len and
+                self._srcs[idx] != SRC_NONE):
+            return BoundingBox(self._label, int(self._srcs[idx]),
+                               *self._rects[idx].tolist())
         else:
             return None
 
     def interpolate(self, bbox, from_frame, to_frame):
+        """interpolate the frames between from_frame and to_frame, from the
+        bounding box at from_frame to bbox
+        """
         cnt = to_frame - from_frame
         if cnt <= 1:
             return
-        from_bbox = self.bboxes[from_frame - self._start]
-        step_x = (bbox.x - from_bbox.x) / cnt
-        step_y = (bbox.y - from_bbox.y) / cnt
-        step_w = (bbox.w - from_bbox.w) / cnt
-        step_h = (bbox.h - from_bbox.h) / cnt
-        bbox = self.bboxes[from_frame - self._start]
-        for i in range(1, cnt):
-            self.bboxes[from_frame - self._start + i].set(
-                int(round(bbox.x + step_x * i)),
-                int(round(bbox.y + step_y * i)),
-                int(round(bbox.w + step_w * i)),
-                int(round(bbox.h + step_h * i)))
+        from_idx = from_frame - self._start
+        self._reserve(from_idx + cnt)
+        key_rects = [self._rects[from_idx], list(bbox)]
+        idxes = np.arange(from_idx + 1, from_idx + cnt)
+        self._rects[idxes] = np.round(interpolate_rects(
+            idxes, [from_idx, from_idx + cnt], key_rects))
+        self._srcs[idxes] = SRC_INTERPOLATED
+
+    def next_keyframe(self, frame_id):
+        """the first keyframe after frame_id, None if there is none"""
+        offset = max(frame_id + 1 - self._start, 0)
+        idxes = np.flatnonzero(self.srcs[offset:] == SRC_KEYFRAME)
+        if idxes.shape[0] == 0:
+            return None
+        return self._start + offset + int(idxes[0])
+
+    def interpolate_keyframes(self, mode='linear', overwrite=True):
+        """re-interpolate the whole tube from its keyframes in one pass
+
+        All frames between the first and last keyframe are filled, tracked
+        frames are kept if overwrite is False. Frames after the last
+        keyframe are not changed.
+        """
+        srcs = self.srcs
+        key_idxes = np.flatnonzero(srcs == SRC_KEYFRAME)
+        if key_idxes.shape[0] < 2:
+            return 0
+        idxes = np.arange(key_idxes[0], key_idxes[-1] + 1)
+        if overwrite:
+            mask = srcs[idxes] != SRC_KEYFRAME
+        else:
+            mask = ((srcs[idxes] == SRC_NONE) |
+                    (srcs[idxes] == SRC_INTERPOLATED))
+        idxes = idxes[mask]
+        if idxes.shape[0] == 0:
+            return 0
+        self._rects[idxes] = np.round(interpolate_rects(
+            idxes, key_idxes, self._rects[key_idxes], mode))
+        self._srcs[idxes] = SRC_INTERPOLATED
+        return idxes.shape[0]
 
     def del_later_bboxes(self, frame_id):
-        for i in range(self._start + len(self.bboxes) - frame_id):
-            self.bboxes.pop()
+        self._load()
+        self._len = min(self._len, max(frame_id - self._start, 0))
         self._end = frame_id - 1
 
+    def copy(self):
+        """a copy of the tube with its own arrays"""
+        self._load()
+        tube = Tube(self._id, self._label, self._start, self._end)
+        tube.set_arrays(self._rects[:self._len].copy(),
+                        self._srcs[:self._len].copy())
+        return tube
+
     def to_dict(self, with_bboxes=True):
         tube_dict = dict(id=self._id, label=self._label,
                          start=self._start, end=self._end)
         if with_bboxes:
             tube_dict['bboxes'] = []
-            for bbox in self.bboxes:
-                tube_dict['bboxes'].append(
-                    {'bbox': list(bbox), 'src': bbox.src})
+            for rect, src in zip(self.rects.tolist(), self.srcs.tolist()):
+                if src == SRC_NONE:
+                    tube_dict['bboxes'].append(None)
+                else:
+                    tube_dict['bboxes'].append({'bbox': rect, 'src': src})
         return tube_dict
 
     @staticmethod
     def from_dict(tube_dict):
         tube = Tube(tube_dict['id'], tube_dict['label'],
                     tube_dict['start'], tube_dict['end'])
-        tube.bboxes = []
-        if 'bboxes' in tube_dict:
-            for bbox in tube_dict['bboxes']:
-                tube.bboxes.append(
-                    BoundingBox(tube.label, bbox['src'], *bbox['bbox']))
+        bboxes = tube_dict.get('bboxes', [])
+        tube._reserve(len(bboxes))
+        for i, bbox in enumerate(bboxes):
+            # empty frames are saved as null (or [] in older files)
+            if bbox:
+                tube._rects[i] = bbox['bbox']
+                tube._srcs[i] = bbox['src']
         return tube
 
 
+def is_binary_file(filename):
+    return filename.endswith('.npz')
+
+
 class Annotation(object):
+    """a set of tubes
+
+    If `journal` is True, every mutation is appended to a journal next to
+    the annotation file by a background thread instead of rewriting the
+    whole file, see `AnnotationJournal`. The journal is replayed on load.
+    """
 
-    def __init__(self, filename=None):
+    def __init__(self, filename=None, journal=False):
         self.tubes = dict()
         self.next_tube_id = 1
+        # frame ranges of the tubes, to look up the tubes of a frame
+        self.index = IntervalIndex()
+        # archive the tubes of a binary annotation file are read from
+        self.npz = None
+        # sequence number of the last mutation
+        self.seq = 0
+        self.lock = threading.RLock()
+        self.use_journal = journal
+        self.journal = None
         if filename is not None:
             self.load(filename)
 
+    def reset(self):
+        if self.npz is not None:
+            self.npz.close()
+            self.npz = None
+        self.tubes = dict()
+        self.next_tube_id = 1
+        self.index.clear()
+        self.seq = 0
+
+    def add_loaded_tube(self, tube):
+        self.tubes[tube.id] = tube
+        self._update_index(tube.id)
+        if self.next_tube_id <= tube.id:
+            self.next_tube_id = tube.id + 1
+
     def load(self, filename):
-        self.filename = filename
+        self.close()
+        with self.lock:
+            self.reset()
+            self.filename = filename
+            self._load_file(filename)
+            for record in read_journal(filename + '.journal'):
+                if record['seq'] > self.seq:
+                    self.apply(record)
+            if self.use_journal:
+                self.journal = AnnotationJournal(self)
+
+    def _load_file(self, filename):
         if not os.path.isfile(filename):
             return
+        if is_binary_file(filename):
+            import annotation_io
+            annotation_io.load_npz(self, filename)
+            return
         with open(filename, 'r') as fin:
             self.data = json.load(fin)
         if 'tubes' in self.data:
-            for tube_id, tube in self.data['tubes'].items():
-                tube_id = int(tube_id)
-                self.tubes[tube_id] = Tube.from_dict(tube)
-                if self.next_tube_id <= tube_id:
-                    self.next_tube_id = tube_id + 1
+            for tube in self.data['tubes'].values():
+                self.add_loaded_tube(Tube.from_dict(tube))
+        self.seq = self.data.get('seq', 0)
 
     def save(self, filename=None):
+        """with a journal, saving to the annotation file is done by the
+        journal thread and this returns immediately
+        """
+        if self.journal is not None and filename in (None, self.filename):
+            self.journal.compact()
+        else:
+            self.write(filename)
+
+    def write(self, filename=None):
+        """write the annotation file and return the sequence number of the
+        last mutation it contains
+        """
         out_file = self.filename if filename is None else filename
-        self.data = dict(tubes=dict())
-        for tube_id, tube in self.tubes.items():
-            self.data['tubes'][tube_id] = tube.to_dict()
-        with open(out_file, 'w') as fout:
-            json.dump(self.data, fout)
+        tmp_file = out_file + '.tmp'
+        with self.lock:
+            if is_binary_file(out_file):
+                import annotation_io
+                # the archive may be the file being replaced
+                annotation_io.close_npz(self)
+            snapshot = self.snapshot()
+        # serialize the copy without holding the lock
+        if is_binary_file(out_file):
+            arrays = annotation_io.npz_snapshot(snapshot)
+            with open(tmp_file, 'wb') as fout:
+                annotation_io.write_npz(arrays, fout)
+        else:
+            data = dict(seq=snapshot.seq, tubes=dict())
+            for tube_id, tube in snapshot.tubes.items():
+                data['tubes'][tube_id] = tube.to_dict()
+            with open(tmp_file, 'w') as fout:
+                json.dump(data, fout)
+        os.replace(tmp_file, out_file)
+        return snapshot.seq
+
+    def snapshot(self):
+        """a copy of the tubes and the sequence number, only the arrays are
+        copied while holding the lock
+        """
+        snapshot = Annotation()
+        with self.lock:
+            snapshot.seq = self.seq
+            snapshot.next_tube_id = self.next_tube_id
+            for tube_id, tube in self.tubes.items():
+                snapshot.tubes[tube_id] = tube.copy()
+        return snapshot
+
+    def close(self):
+        """fold the journal into the annotation file and stop it"""
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def _record(self, op, *args):
+        self.seq += 1
+        if self.journal is not None:
+            self.journal.append(dict(seq=self.seq, op=op, args=args))
+
+    def apply(self, record):
+        """apply a journal record"""
+        args = record['args']
+        op = record['op']
+        if op == 'add_tube':
+            self.next_tube_id = args[0]
+            self.add_tube(*args[1:])
+        elif op == 'set_bbox':
+            tube_id, frame_id, rect, src = args
+            self.set_bbox(tube_id, frame_id, BoundingBox(None, src, *rect))
+        elif op == 'interpolate':
+            tube_id, rect, src, from_frame, to_frame = args
+            self.interpolate(tube_id, BoundingBox(None, src, *rect),
+                             from_frame, to_frame)
+        else:
+            getattr(self, op)(*args)
+        self.seq = record['seq']
 
     def tube(self, tube_id):
         if tube_id in self.tubes:
@@ -138,35 +444,89 @@ class Annotation(object):
     def tube_end(self, tube_id):
         return self.tubes[tube_id].end
 
+    def _update_index(self, tube_id):
+        tube = self.tubes[tube_id]
+        self.index.update(tube_id, tube.start, tube.end)
+
     def add_tube(self, label, start):
-        self.tubes[self.next_tube_id] = Tube(self.next_tube_id, label, start)
-        self.next_tube_id += 1
+        with self.lock:
+            tube_id = self.next_tube_id
+            self.tubes[tube_id] = Tube(tube_id, label, start)
+            self._update_index(tube_id)
+            self.next_tube_id += 1
+            self._record('add_tube', tube_id, label, start)
 
     def del_tube(self, tube_id):
-        del self.tubes[tube_id]
+        with self.lock:
+            del self.tubes[tube_id]
+            self.index.remove(tube_id)
+            self._record('del_tube', tube_id)
+
+    def set_label(self, tube_id, label):
+        with self.lock:
+            self.tubes[tube_id].label = label
+            self._record('set_label', tube_id, label)
 
     def set_bbox(self, tube_id, frame_id, bbox):
-        self.tubes[tube_id].set_bbox(frame_id, bbox)
+        with self.lock:
+            self.tubes[tube_id].set_bbox(frame_id, bbox)
+            self._update_index(tube_id)
+            self._record('set_bbox', tube_id, frame_id,
+                         [int(v) for v in bbox], int(bbox.src))
 
     def interpolate(self, tube_id, bbox, from_frame, to_frame):
-        self.tubes[tube_id].interpolate(bbox, from_frame, to_frame)
+        with self.lock:
+            self.tubes[tube_id].interpolate(bbox, from_frame, to_frame)
+            self._record('interpolate', tube_id, [int(v) for v in bbox],
+                         int(bbox.src), from_frame, to_frame)
+
+    def next_keyframe(self, tube_id, frame_id):
+        with self.lock:
+            return self.tubes[tube_id].next_keyframe(frame_id)
+
+    def interpolate_keyframes(self, tube_id, mode='linear', overwrite=True):
+        with self.lock:
+            cnt = self.tubes[tube_id].interpolate_keyframes(mode, overwrite)
+            self._record('interpolate_keyframes', tube_id, mode, overwrite)
+        return cnt
 
     def del_later_bboxes(self, tube_id, frame_id):
-        self.tubes[tube_id].del_later_bboxes(frame_id)
+        with self.lock:
+            self.tubes[tube_id].del_later_bboxes(frame_id)
+            self._update_index(tube_id)
+            self._record('del_later_bboxes', tube_id, frame_id)
 
     def get_bbox(self, tube_id, frame_id):
-        if tube_id not in self.tubes:
+        tube = self.tubes.get(tube_id)
+        if tube is None:
             return None
-        return self.tubes[tube_id].get_bbox(frame_id)
+        return tube.get_bbox(frame_id)
 
     def get_bboxes(self, frame_id, ignored_tube_id=None):
         bboxes = []
-        for tube_id, tube in self.tubes.items():
-            if tube_id == ignored_tube_id:
-                continue
-            bbox = tube.get_bbox(frame_id)
-            if bbox is not None:
-                bboxes.append(bbox)
+        # the index is updated by the tracking threads
+        with self.lock:
+            for tube_id in self.index.query(frame_id):
+                if tube_id == ignored_tube_id:
+                    continue
+                bbox = self.tubes[tube_id].get_bbox(frame_id)
+                if bbox is not None:
+                    bboxes.append(bbox)
+        return bboxes
+
+    def get_bboxes_in_range(self, start, end):
+        """bounding boxes of every frame in [start, end]
+        return a dict from frame id to the list of bounding boxes
+        """
+        bboxes = {frame_id: [] for frame_id in range(start, end + 1)}
+        with self.lock:
+            for tube_id in self.index.query_range(start, end):
+                tube = self.tubes[tube_id]
+                for frame_id in range(max(start, tube.start),
+                                      min(end, tube.end) + 1):
+                    bbox = tube.get_bbox(frame_id)
+                    if bbox is not None:
+                        bboxes[frame_id].append(bbox)
         return bboxes
 
     def get_brief_info(self):
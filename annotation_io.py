@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""binary annotation format
+
+An annotation is saved as a NumPy .npz archive. The tube headers are small
+arrays (`ids`, `labels`, `starts`, `ends`, `lengths`) and every tube has
+its own members, so that a tube is only decoded when it is first used:
+
+- `<id>_offsets`, `<id>_rects`, `<id>_srcs`: frames stored explicitly
+- `<id>_runs`: [first, last] offsets of interpolated frames which are
+  restored by linear interpolation between their neighbouring frames
+
+Frames without a bounding box are not stored at all.
+"""
+
+import argparse
+
+import numpy as np
+
+from annotation import (Annotation, Tube, SRC_NONE, SRC_INTERPOLATED,
+                        interpolate_rects)
+
+
+def find_runs(mask):
+    """[first, last] of every run of True in a 1-d boolean array"""
+    padded = np.concatenate(([False], mask, [False])).astype(np.int8)
+    changes = np.flatnonzero(np.diff(padded))
+    return changes.reshape(-1, 2) - [0, 1]
+
+
+def interpolate_run(rects, first, last):
+    idxes = np.arange(first, last + 1)
+    return np.round(interpolate_rects(
+        idxes, [first - 1, last + 1], rects[[first - 1, last + 1]]))
+
+
+def encode_tube(tube):
+    """split a tube into explicit frames and runs of interpolated frames"""
+    rects = tube.rects
+    srcs = tube.srcs
+    explicit = srcs != SRC_NONE
+    runs = []
+    for first, last in find_runs(srcs == SRC_INTERPOLATED):
+        # a run can only be restored if it lies between explicit frames and
+        # the stored boxes equal the linear interpolation
+        if (first == 0 or last == len(srcs) - 1 or
+                srcs[first - 1] in (SRC_NONE, SRC_INTERPOLATED) or
+                srcs[last + 1] in (SRC_NONE, SRC_INTERPOLATED)):
+            continue
+        if np.array_equal(interpolate_run(rects, first, last),
+                          rects[first: last + 1]):
+            explicit[first: last + 1] = False
+            runs.append((first, last))
+    offsets = np.flatnonzero(explicit).astype(np.int32)
+    return dict(offsets=offsets, rects=rects[offsets], srcs=srcs[offsets],
+                runs=np.array(runs, dtype=np.int32).reshape(-1, 2))
+
+
+def decode_tube(npz, tube, length):
+    prefix = '{}_'.format(tube.id)
+    offsets = npz[prefix + 'offsets']
+    rects = np.zeros((length, 4), dtype=np.int32)
+    srcs = np.full(length, SRC_NONE, dtype=np.uint8)
+    rects[offsets] = npz[prefix + 'rects']
+    srcs[offsets] = npz[prefix + 'srcs']
+    for first, last in npz[prefix + 'runs'].tolist():
+        rects[first: last + 1] = interpolate_run(rects, first, last)
+        srcs[first: last + 1] = SRC_INTERPOLATED
+    tube.set_arrays(rects, srcs)
+
+
+def npz_snapshot(annotation):
+    """arrays of an annotation to be written by write_npz"""
+    close_npz(annotation)
+    tubes = [annotation.tubes[tube_id] for tube_id in sorted(annotation.tubes)]
+    arrays = dict(
+        seq=np.array(annotation.seq, dtype=np.int64),
+        ids=np.array([tube.id for tube in tubes], dtype=np.int64),
+        labels=np.array([tube.label for tube in tubes], dtype=np.str_),
+        starts=np.array([tube.start for tube in tubes], dtype=np.int64),
+        ends=np.array([tube.end for tube in tubes], dtype=np.int64),
+        lengths=np.array([len(tube) for tube in tubes], dtype=np.int64))
+    for tube in tubes:
+        for key, value in encode_tube(tube).items():
+            arrays['{}_{}'.format(tube.id, key)] = value
+    return arrays
+
+
+def write_npz(arrays, fout, compressed=True):
+    # np.savez appends .npz to filenames without it, so write to a file
+    if compressed:
+        np.savez_compressed(fout, **arrays)
+    else:
+        np.savez(fout, **arrays)
+
+
+def load_npz(annotation, filename):
+    """read the tube headers, tubes are decoded when they are first used"""
+    npz = np.load(filename)
+    annotation.npz = npz
+    if 'seq' in npz.files:
+        annotation.seq = int(npz['seq'])
+    for tube_id, label, start, end, length in zip(
+            npz['ids'].tolist(), npz['labels'].tolist(),
+            npz['starts'].tolist(), npz['ends'].tolist(),
+            npz['lengths'].tolist()):
+        tube = Tube(tube_id, label, start, end)
+        tube.set_loader(lambda tube, npz=npz, length=length:
+                        decode_tube(npz, tube, length))
+        annotation.add_loaded_tube(tube)
+
+
+def close_npz(annotation):
+    """decode the remaining tubes and close the archive they are read from"""
+    if annotation.npz is None:
+        return
+    for tube in annotation.tubes.values():
+        len(tube)
+    annotation.npz.close()
+    annotation.npz = None
+
+
+def convert(in_file, out_file):
+    """convert between the json (.annotation) and binary (.npz) formats"""
+    annotation = Annotation(in_file)
+    annotation.write(out_file)
+    close_npz(annotation)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='convert annotations between json and npz')
+    parser.add_argument('in_file')
+    parser.add_argument('out_file')
+    args = parser.parse_args()
+    convert(args.in_file, args.out_file)
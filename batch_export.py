@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""export the annotated videos of a directory without Qt
+
+Every video with a `.annotation` (or `.annotation.npz`) sidecar is exported
+to `<out_dir>/<name>_annotated.<ext>`. Videos are exported concurrently by
+a pool of processes and outputs newer than their video and annotation are
+skipped.
+"""
+
+import argparse
+import multiprocessing
+import os
+import time
+
+import ckutils
+
+import exporter
+from annotation import Annotation
+
+
+def annotation_file(video_file):
+    """the annotation sidecar of a video or None"""
+    filename = video_file + '.annotation'
+    if os.path.isfile(filename + '.npz'):
+        return filename + '.npz'
+    if os.path.isfile(filename):
+        return filename
+    return None
+
+
+def output_file(video_file, out_dir, ext='avi'):
+    name = os.path.splitext(os.path.basename(video_file))[0]
+    return os.path.join(out_dir, '{}_annotated.{}'.format(name, ext))
+
+
+def is_up_to_date(out_file, video_file, ann_file):
+    if not os.path.isfile(out_file):
+        return False
+    inputs = [video_file, ann_file]
+    if os.path.isfile(ann_file + '.journal'):
+        inputs.append(ann_file + '.journal')
+    mtime = os.path.getmtime(out_file)
+    return all(os.path.getmtime(filename) <= mtime for filename in inputs)
+
+
+def export_one(args):
+    video_file, ann_file, out_file, fourcc, scale = args
+    annotation = Annotation(ann_file)
+    # write to a temporary file so that an interrupted export is never
+    # taken for an up-to-date output
+    base, ext = os.path.splitext(out_file)
+    tmp_file = base + '.part' + ext
+    try:
+        summary = exporter.export_video(video_file, tmp_file, annotation,
+                                        fourcc=fourcc, scale=scale)
+        os.replace(tmp_file, out_file)
+    finally:
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+    summary['video'] = video_file
+    return summary
+
+
+def find_tasks(video_dir, out_dir, exts, fourcc='XVID', scale=1.0,
+               out_ext='avi', force=False):
+    """return the export tasks and the number of skipped videos"""
+    tasks = []
+    skipped = 0
+    for filename in ckutils.scandir(video_dir, exts):
+        video_file = os.path.join(video_dir, filename)
+        ann_file = annotation_file(video_file)
+        if ann_file is None:
+            continue
+        out_file = output_file(video_file, out_dir, out_ext)
+        if not force and is_up_to_date(out_file, video_file, ann_file):
+            skipped += 1
+            continue
+        tasks.append((video_file, ann_file, out_file, fourcc, scale))
+    return tasks, skipped
+
+
+def batch_export(video_dir, out_dir=None, worker_num=None, fourcc='XVID',
+                 scale=1.0, exts=('mp4', 'mkv', 'avi', 'flv', 'm4v'),
+                 out_ext='avi', force=False):
+    """export all annotated videos of a directory and print a summary"""
+    out_dir = out_dir if out_dir is not None else video_dir
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    tasks, skipped = find_tasks(video_dir, out_dir, list(exts), fourcc,
+                                scale, out_ext, force)
+    print('{} videos to export, {} up to date'.format(len(tasks), skipped))
+    if not tasks:
+        return []
+    if worker_num is None:
+        worker_num = multiprocessing.cpu_count()
+    start_time = time.time()
+    summaries = []
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(min(worker_num, len(tasks))) as pool:
+        for summary in pool.imap_unordered(export_one, tasks):
+            print('{}: {} frames in {:.1f}s, {:.1f} fps'.format(
+                os.path.basename(summary['video']), summary['frames'],
+                summary['seconds'], summary['fps']))
+            summaries.append(summary)
+    seconds = time.time() - start_time
+    frames = sum(summary['frames'] for summary in summaries)
+    print('exported {} videos, {} frames in {:.1f}s, {:.1f} fps'.format(
+        len(summaries), frames, seconds,
+        frames / seconds if seconds > 0 else 0.0))
+    return summaries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='export the annotated videos of a directory')
+    parser.add_argument('video_dir')
+    parser.add_argument('-o', '--out-dir',
+                        help='output directory, default: video_dir')
+    parser.add_argument('-j', '--workers', type=int,
+                        help='number of videos exported at the same time, '
+                        'default: number of cpus')
+    parser.add_argument('--fourcc', default='XVID')
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--ext', default='avi', help='output extension')
+    parser.add_argument('--video-exts', nargs='+',
+                        default=['mp4', 'mkv', 'avi', 'flv', 'm4v'])
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='export up-to-date outputs again')
+    args = parser.parse_args()
+    batch_export(args.video_dir, args.out_dir, args.workers, args.fourcc,
+                 args.scale, args.video_exts, args.ext, args.force)
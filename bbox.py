@@ -1,5 +1,10 @@
 from ckutils.rect import Rect
 
+# where a bounding box comes from
+SRC_TRACKED = 0
+SRC_KEYFRAME = 1
+SRC_INTERPOLATED = 2
+
 
 class BoundingBox(Rect):
 
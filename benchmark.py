@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from annotation import Annotation, Tube
+from bbox import BoundingBox
+from subtitle import Subtitle, WordIndex
+from tracker import Tracker, TrackFrame
+from video_splitter import VideoSplitter
+
+
+def timeit(func, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        func()
+    return (time.time() - start) / repeat
+
+
+def bench_frame_index(tube_num=5000, frame_num=100000, query_num=2000):
+    """compare the interval index of Annotation with a scan of all tubes"""
+    random.seed(0)
+    annotation = Annotation()
+    for _ in range(tube_num):
+        start = random.randint(1, frame_num)
+        end = min(start + random.randint(0, 300), frame_num)
+        annotation.add_tube('obj', start)
+        tube_id = annotation.next_tube_id - 1
+        for frame_id in range(start, end + 1):
+            annotation.set_bbox(tube_id, frame_id,
+                                BoundingBox('obj', 0, 0, 0, 10, 10))
+    frames = [random.randint(1, frame_num) for _ in range(query_num)]
+
+    def scan():
+        for frame_id in frames:
+            bboxes = []
+            for tube in annotation.tubes.values():
+                bbox = tube.get_bbox(frame_id)
+                if bbox is not None:
+                    bboxes.append(bbox)
+
+    def indexed():
+        for frame_id in frames:
+            annotation.get_bboxes(frame_id)
+
+    scan_time = timeit(scan, 1) / query_num
+    index_time = timeit(indexed, 1) / query_num
+    print('{} tubes, {} frames'.format(tube_num, frame_num))
+    print('scan:  {:.3f} ms/frame'.format(scan_time * 1000))
+    print('index: {:.3f} ms/frame ({:.1f}x)'.format(
+        index_time * 1000, scan_time / index_time))
+
+
+def bench_tube_memory(frame_num=100000):
+    """compare the memory of a columnar tube with a list of BoundingBox"""
+
+    def traced(func):
+        tracemalloc.start()
+        obj = func()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return obj, size
+
+    def build_list():
+        return [BoundingBox('obj', 0, i, i, 10, 10) for i in range(frame_num)]
+
+    def build_tube():
+        tube = Tube(1, 'obj', 1)
+        for i in range(frame_num):
+            tube.set_bbox(i + 1, BoundingBox('obj', 0, i, i, 10, 10))
+        return tube
+
+    _, list_size = traced(build_list)
+    _, tube_size = traced(build_tube)
+    print('{} frames'.format(frame_num))
+    print('list of BoundingBox: {:.1f} MB'.format(list_size / 2**20))
+    print('columnar tube:       {:.1f} MB ({:.1f}x)'.format(
+        tube_size / 2**20, list_size / tube_size))
+
+
+def synthetic_clip(frame_num=150, width=1920, height=1080, obj_w=240,
+                   obj_h=180):
+    """frames of a textured object moving over a textured background
+    yield (TrackFrame, ground truth BoundingBox)
+    """
+    rng = np.random.RandomState(0)
+    background = cv2.GaussianBlur(
+        rng.randint(0, 256, (height, width, 3)).astype(np.uint8), (7, 7), 0)
+    obj = cv2.GaussianBlur(
+        rng.randint(0, 256, (obj_h, obj_w, 3)).astype(np.uint8), (5, 5), 0)
+    for i in range(frame_num):
+        # a smooth trajectory which stays inside the frame
+        x = int((width - obj_w) * (0.5 + 0.4 * np.sin(i / 40.0)))
+        y = int((height - obj_h) * (0.5 + 0.4 * np.sin(i / 25.0)))
+        img = background.copy()
+        img[y: y + obj_h, x: x + obj_w] = obj
+        yield (TrackFrame(i + 1, img),
+               BoundingBox('obj', 0, x, y, obj_w, obj_h))
+
+
+def iou(bbox1, bbox2):
+    w = min(bbox1.right, bbox2.right) - max(bbox1.left, bbox2.left)
+    h = min(bbox1.bottom, bbox2.bottom) - max(bbox1.top, bbox2.top)
+    inter = max(w, 0) * max(h, 0)
+    area1 = (bbox1.right - bbox1.left) * (bbox1.bottom - bbox1.top)
+    area2 = (bbox2.right - bbox2.left) * (bbox2.bottom - bbox2.top)
+    return inter / float(area1 + area2 - inter)
+
+
+def bench_tracking(frame_num=150, width=1920, height=1080):
+    """compare full resolution tracking with the downscaled modes on a
+    synthetic clip
+    """
+    modes = [('full resolution', dict()),
+             ('downscaled', dict(downscale=True)),
+             ('downscaled gray', dict(downscale=True, grayscale=True))]
+    print('{} frames of {}x{}'.format(frame_num, width, height))
+    for name, kwargs in modes:
+        tracker = Tracker(**kwargs)
+        ious = []
+        seconds = 0.0
+        for frame, gt_bbox in synthetic_clip(frame_num, width, height):
+            start = time.time()
+            if frame.id == 1:
+                tracker.start_track(frame, gt_bbox)
+            else:
+                bbox, _ = tracker.update(frame)
+                ious.append(iou(bbox, gt_bbox))
+            seconds += time.time() - start
+        print('{:18s} {:6.1f} fps, mean IoU {:.3f}, min IoU {:.3f}'.format(
+            name + ':', frame_num / seconds, np.mean(ious), np.min(ious)))
+
+
+def write_scene_clip(filename, scene_num=20, scene_len=100, width=640,
+                     height=360, fps=25):
+    """write a clip of panning scenes, return the 0-based scene cuts"""
+    rng = np.random.RandomState(0)
+    vwriter = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'MJPG'),
+                              fps, (width, height))
+    for k in range(scene_num):
+        # textures around a dark or a bright level in turn
+        level = 60 if k % 2 == 0 else 190
+        texture = rng.randint(level - 50, level + 50, (9, 32, 3))
+        scene = cv2.resize(texture.astype(np.uint8), (width * 2, height),
+                           interpolation=cv2.INTER_LINEAR)
+        for i in range(scene_len):
+            x = i * width // scene_len
+            vwriter.write(np.ascontiguousarray(scene[:, x: x + width]))
+    vwriter.release()
+    return [i * scene_len for i in range(1, scene_num)]
+
+
+def bench_scene_detection(scene_num=20, scene_len=100):
+    """compare the in-process scene detectors with ffprobe"""
+    tmp_dir = tempfile.mkdtemp()
+    filename = os.path.join(tmp_dir, 'scenes.avi')
+    cuts = write_scene_clip(filename, scene_num, scene_len)
+    frame_num = scene_num * scene_len
+    splitters = [
+        ('sad', VideoSplitter(method='sad')),
+        ('sad x{}'.format(multiprocessing.cpu_count()),
+         VideoSplitter(method='sad', chunk_num=multiprocessing.cpu_count(),
+                       min_chunk_size=100)),
+        ('hist', VideoSplitter(thr=0.1, method='hist'))]
+    if shutil.which('ffprobe') is not None:
+        splitters.append(('ffprobe', VideoSplitter(method='ffprobe')))
+    print('{} frames, {} cuts'.format(frame_num, len(cuts)))
+    try:
+        for name, splitter in splitters:
+            start = time.time()
+            sections = splitter.split(filename, 25, frame_num, save=False)
+            seconds = time.time() - start
+            found = [section[0] for section in sections[1:]]
+            print('{:10s} {:6.2f}s {:7.1f} fps, {} of {} cuts found'.format(
+                name + ':', seconds, frame_num / seconds,
+                len(set(found) & set(cuts)), len(cuts)))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_word_index(cue_num=50000, vocab_size=20000, query_num=1000,
+                     max_num=200):
+    """build time and lookup latency of the subtitle word index, with at
+    most max_num slots per lookup like the time-slot tool
+    """
+    rng = np.random.RandomState(0)
+    vocab = ['w{}'.format(i) for i in range(vocab_size)]
+    # word frequencies follow a Zipf-like distribution
+    probs = 1.0 / np.arange(1, vocab_size + 1)
+    probs /= probs.sum()
+    lengths = rng.randint(3, 15, cue_num)
+    word_ids = rng.choice(vocab_size, lengths.sum(), p=probs).tolist()
+    cues = []
+    pos = 0
+    for i, length in enumerate(lengths.tolist()):
+        words = [vocab[word_id] for word_id in word_ids[pos: pos + length]]
+        cues.append((i * 2.5, i * 2.5 + 2.0, ' '.join(words)))
+        pos += length
+    subtitle = Subtitle()
+    subtitle.set_cues(cues)
+    start = time.time()
+    word_index = WordIndex(subtitle, 25)
+    build_time = time.time() - start
+    queries = [vocab[int(i)] for i in rng.randint(0, vocab_size, query_num)]
+    queries += [' '.join(cues[int(i)][2].split()[:2])
+                for i in rng.randint(0, cue_num, query_num)]
+    # the most frequent words return the most slots
+    queries += vocab[:10]
+    latencies = []
+    for query in queries:
+        start = time.time()
+        word_index.lookup(query, max_num)
+        latencies.append(time.time() - start)
+    print('{} cues, {} words, built in {:.2f}s'.format(
+        cue_num, len(word_index), build_time))
+    print('lookup: {:.3f} ms mean, {:.3f} ms max'.format(
+        np.mean(latencies) * 1000, np.max(latencies) * 1000))
+
+
+def bench_playback(scene_num=4, scene_len=75, width=1920, height=1080,
+                   fps=25, display_size=(960, 540)):
+    """playback throughput of the Video engine of the labeling tools, the
+    frames are decoded by the playback threads and shown by a headless Qt
+    event loop like in the tools
+    """
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5.QtWidgets import QApplication
+    from video import Video
+    app = QApplication.instance() or QApplication([])
+    tmp_dir = tempfile.mkdtemp()
+    filename = os.path.join(tmp_dir, 'playback.avi')
+    write_scene_clip(filename, scene_num, scene_len, width, height, fps)
+    frame_num = scene_num * scene_len
+    shown = []
+
+    def show(frame):
+        frame.scaled_pixmap(*display_size)
+        shown.append(time.time())
+
+    video = Video(filename)
+    video.set_display_size(*display_size)
+    video.frame_updated.connect(show)
+    print('{} frames of {}x{} at {} fps, shown at {}x{}'.format(
+        frame_num, width, height, fps, *display_size))
+    # the display cache is cold in the first pass and hit in the others
+    passes = [('cold cache', 0), ('cached', 0), ('source fps', fps)]
+    try:
+        for name, max_fps in passes:
+            video.max_fps = max_fps
+            video.jump_to_frame(1)
+            underruns = video.prefetch_stats()['underruns']
+            del shown[:]
+            start = time.time()
+            deadline = start + 3.0 * frame_num / fps + 10
+            video.play_forward()
+            while len(shown) < frame_num - 1 and time.time() < deadline:
+                app.processEvents()
+                time.sleep(0.001)
+            video.pause()
+            seconds = shown[-1] - start if shown else float('nan')
+            # frames shown later than two frame intervals after the last
+            late = int(np.sum(np.diff([start] + shown) > 2.0 / fps))
+            print('{:12s} {:6.1f} fps ({:.2f}x real time), {} late frames, '
+                  '{} prefetch underruns'.format(
+                      name + ':', len(shown) / seconds,
+                      len(shown) / seconds / fps, late,
+                      video.prefetch_stats()['underruns'] - underruns))
+    finally:
+        video.pause()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+benchmarks = dict(frame_index=bench_frame_index,
+                  tube_memory=bench_tube_memory,
+                  tracking=bench_tracking,
+                  scene_detection=bench_scene_detection,
+                  word_index=bench_word_index,
+                  playback=bench_playback)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='labeltool benchmarks')
+    parser.add_argument('name', choices=sorted(benchmarks.keys()))
+    args = parser.parse_args()
+    benchmarks[args.name]()
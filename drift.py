@@ -0,0 +1,128 @@
+import threading
+from collections import defaultdict
+
+import cv2
+import numpy as np
+
+
+def crop(img, bbox, max_size=32):
+    """the region of a bounding box, downsampled so that its longer side is
+    at most max_size pixels
+    """
+    region = img[max(bbox.top, 0): bbox.bottom, max(bbox.left, 0): bbox.right]
+    h, w = region.shape[:2]
+    if h == 0 or w == 0:
+        return None
+    scale = float(max_size) / max(h, w)
+    if scale < 1:
+        region = cv2.resize(region, (max(int(w * scale), 1),
+                                     max(int(h * scale), 1)),
+                            interpolation=cv2.INTER_AREA)
+    return region
+
+
+def batch_hist(regions, bins=16):
+    """normalized colour histograms of several regions in one bincount,
+    return an array of shape (len(regions), bins ** 3)
+    """
+    hist_size = bins ** 3
+    idxes = []
+    for i, region in enumerate(regions):
+        q = (region.reshape(-1, 3).astype(np.int32) * bins) >> 8
+        idxes.append(i * hist_size +
+                     (q[:, 0] * bins + q[:, 1]) * bins + q[:, 2])
+    counts = np.bincount(np.concatenate(idxes),
+                         minlength=len(regions) * hist_size)
+    hists = counts.reshape(len(regions), hist_size).astype(np.float32)
+    return hists / np.maximum(hists.sum(axis=1, keepdims=True), 1)
+
+
+def correlation(hists, ref_hists):
+    """row-wise correlation of histograms, as cv2.HISTCMP_CORREL"""
+    a = hists - hists.mean(axis=1, keepdims=True)
+    b = ref_hists - ref_hists.mean(axis=1, keepdims=True)
+    denom = np.sqrt((a * a).sum(axis=1) * (b * b).sum(axis=1))
+    return (a * b).sum(axis=1) / np.maximum(denom, 1e-12)
+
+
+def low_confidence(scores, sim_thr):
+    """sorted frames of a {frame id: similarity} dict below sim_thr"""
+    return sorted(frame_id for frame_id, sim in scores.items()
+                  if sim < sim_thr)
+
+
+class DriftDetector(object):
+    """detect trackers drifting away from their object
+
+    The colour histogram of the region every tube starts from is computed
+    once and cached. Candidate regions of all tubes in a frame are
+    downsampled and compared to their references at once, and the
+    similarity scores are kept per tube and frame. The scores can be read
+    from another thread than the one updating them.
+    """
+
+    def __init__(self, bins=16, max_size=32):
+        self.bins = bins
+        self.max_size = max_size
+        self.ref_hists = dict()
+        # tube id -> {frame id: similarity}
+        self.scores = defaultdict(dict)
+        self._lock = threading.Lock()
+
+    def __contains__(self, tube_id):
+        return tube_id in self.ref_hists
+
+    def set_reference(self, tube_id, img, bbox):
+        region = crop(img, bbox, self.max_size)
+        if region is None:
+            return
+        self.ref_hists[tube_id] = batch_hist([region], self.bins)[0]
+        with self._lock:
+            self.scores.pop(tube_id, None)
+
+    def remove(self, tube_id):
+        self.ref_hists.pop(tube_id, None)
+        with self._lock:
+            self.scores.pop(tube_id, None)
+
+    def clear(self):
+        self.ref_hists.clear()
+        with self._lock:
+            self.scores.clear()
+
+    def update(self, frame_id, img, bboxes):
+        """score the bounding boxes of several tubes in a frame
+
+        bboxes is a dict from tube id to bounding box, return a dict from
+        tube id to the similarity with the reference (0 for empty boxes)
+        """
+        tube_ids = []
+        regions = []
+        results = dict()
+        for tube_id, bbox in bboxes.items():
+            region = crop(img, bbox, self.max_size)
+            if region is None or tube_id not in self.ref_hists:
+                results[tube_id] = 0.0
+            else:
+                tube_ids.append(tube_id)
+                regions.append(region)
+        if regions:
+            sims = correlation(
+                batch_hist(regions, self.bins),
+                np.stack([self.ref_hists[tube_id] for tube_id in tube_ids]))
+            results.update(zip(tube_ids, sims.tolist()))
+        with self._lock:
+            for tube_id, sim in results.items():
+                self.scores[tube_id][frame_id] = sim
+        return results
+
+    def score(self, tube_id, frame_id):
+        """similarity of a tube at a frame, None if it is not scored"""
+        with self._lock:
+            return self.scores.get(tube_id, {}).get(frame_id)
+
+    def low_confidence(self, tube_id, sim_thr):
+        """sorted frames of a tube with a similarity below sim_thr"""
+        with self._lock:
+            scores = dict(self.scores.get(tube_id, {}))
+        return low_confidence(scores, sim_thr)
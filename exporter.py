@@ -0,0 +1,401 @@
+import multiprocessing
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import cv2
+
+from ckutils.video import VideoReader
+from subtitle import draw_subtitle
+
+
+def frame_count(video_file):
+    vreader = VideoReader(video_file)
+    frame_cnt = vreader.frame_cnt
+    vreader.release()
+    return frame_cnt
+
+
+def video_fps(video_file):
+    vreader = VideoReader(video_file)
+    fps = vreader.fps
+    vreader.release()
+    return fps
+
+
+def get_overlays(annotation, start, end):
+    """picklable bounding boxes of the frames in [start, end]
+    return a dict from frame id to a list of (left_top, right_bottom, label)
+    """
+    overlays = dict()
+    for frame_id, bboxes in annotation.get_bboxes_in_range(start,
+                                                           end).items():
+        overlays[frame_id] = [(bbox.left_top, bbox.right_bottom, bbox.label)
+                              for bbox in bboxes]
+    return overlays
+
+
+def draw_overlays(img, overlays, line_thickness):
+    for left_top, right_bottom, label in overlays:
+        cv2.rectangle(img, left_top, right_bottom, (0, 0, 255),
+                      line_thickness)
+        cv2.putText(img, label, left_top, cv2.FONT_HERSHEY_SIMPLEX, 1.2,
+                    (0, 0, 255), line_thickness)
+    return img
+
+
+def output_size(width, height, scale):
+    return (int(round(width * scale)), int(round(height * scale)))
+
+
+class ExportPipeline(object):
+    """export frames [start, end] in three stages running in their own
+    threads and connected by bounded queues
+
+    - decode: seek once to start and read the following frames in order
+    - overlay: draw the bounding boxes and subtitles, and rescale
+    - encode: write the frames to the output video
+
+    OpenCV releases the GIL while decoding, resizing and encoding, so the
+    stages overlap. `cancel` stops all of them. A stage that raises cancels
+    the others, and the exception is raised again by `run`.
+    """
+
+    stages = ('decode', 'overlay', 'encode')
+
+    def __init__(self, video_file, out_file, overlays, start, end,
+                 fourcc='XVID', scale=1.0, queue_size=32, progress=None,
+                 cancel_event=None, subtitle=None):
+        self.video_file = video_file
+        self.out_file = out_file
+        self.overlays = overlays
+        self.start = start
+        self.end = end
+        self.fourcc = fourcc
+        self.scale = scale
+        self.queue_size = queue_size
+        self.progress = progress
+        self.subtitle = subtitle
+        self.cancel_event = (cancel_event if cancel_event is not None else
+                             threading.Event())
+        # frames processed and seconds spent by every stage
+        self.stats = {stage: dict(frames=0, seconds=0.0)
+                      for stage in self.stages}
+        # the first exception raised by a stage
+        self.error = None
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def _run_stage(self, stage, *args):
+        """run a stage, and stop the other ones if it fails"""
+        try:
+            stage(*args)
+        except Exception as err:
+            if self.error is None:
+                self.error = err
+            # the other stages stop waiting on their queues
+            self.cancel()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def _put(self, frame_queue, item):
+        while not self.cancelled:
+            try:
+                frame_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, frame_queue):
+        while not self.cancelled:
+            try:
+                return frame_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def _count(self, stage, start_time):
+        self.stats[stage]['frames'] += 1
+        self.stats[stage]['seconds'] += time.time() - start_time
+
+    def _decode(self, vreader, out_queue):
+        start_time = time.time()
+        ret, img = vreader.get_frame(self.start)
+        frame_id = self.start
+        while ret and frame_id <= self.end:
+            self._count('decode', start_time)
+            if not self._put(out_queue, (frame_id, img)):
+                return
+            frame_id += 1
+            start_time = time.time()
+            if frame_id <= self.end:
+                ret, img = vreader.read()
+        self._put(out_queue, None)
+
+    def _overlay(self, in_queue, out_queue, size, line_thickness, fps):
+        while True:
+            item = self._get(in_queue)
+            if item is None:
+                break
+            start_time = time.time()
+            frame_id, img = item
+            draw_overlays(img, self.overlays.get(frame_id, []),
+                          line_thickness)
+            if self.subtitle is not None:
+                draw_subtitle(img, self.subtitle.get_subtitle(
+                    (frame_id - 1) / fps), line_thickness)
+            if self.scale != 1.0:
+                img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+            self._count('overlay', start_time)
+            if not self._put(out_queue, img):
+                return
+        self._put(out_queue, None)
+
+    def _encode(self, in_queue, vwriter):
+        reported = 0
+        while True:
+            img = self._get(in_queue)
+            if img is None:
+                break
+            start_time = time.time()
+            vwriter.write(img)
+            self._count('encode', start_time)
+            written = self.stats['encode']['frames']
+            if self.progress is not None and written - reported >= 25:
+                self.progress(written - reported)
+                reported = written
+        written = self.stats['encode']['frames']
+        if self.progress is not None and written > reported:
+            self.progress(written - reported)
+
+    def run(self):
+        """run the pipeline and return the number of written frames"""
+        vreader = VideoReader(self.video_file)
+        size = output_size(vreader.width, vreader.height, self.scale)
+        line_thickness = max(int(min(vreader.width, vreader.height) / 200),
+                             1)
+        vwriter = cv2.VideoWriter(self.out_file,
+                                  cv2.VideoWriter_fourcc(*self.fourcc),
+                                  vreader.fps, size)
+        decoded = queue.Queue(self.queue_size)
+        overlaid = queue.Queue(self.queue_size)
+        threads = [
+            threading.Thread(target=self._run_stage,
+                             args=(self._decode, vreader, decoded)),
+            threading.Thread(target=self._run_stage,
+                             args=(self._overlay, decoded, overlaid, size,
+                                   line_thickness, vreader.fps))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        self._run_stage(self._encode, overlaid, vwriter)
+        for t in threads:
+            t.join()
+        vreader.release()
+        vwriter.release()
+        if self.error is not None:
+            raise self.error
+        return self.stats['encode']['frames']
+
+    def throughput(self):
+        """frames per second of the busy time of every stage"""
+        return {stage: (stat['frames'] / stat['seconds']
+                        if stat['seconds'] > 0 else 0.0)
+                for stage, stat in self.stats.items()}
+
+
+def export_segment(video_file, out_file, overlays, start, end,
+                   fourcc='XVID', scale=1.0, progress=None,
+                   cancel_event=None, subtitle=None):
+    """export frames [start, end] with an ExportPipeline
+    progress(n) is called with the number of newly written frames
+    return the stats of the pipeline stages
+    """
+    pipeline = ExportPipeline(video_file, out_file, overlays, start, end,
+                              fourcc, scale, progress=progress,
+                              cancel_event=cancel_event, subtitle=subtitle)
+    pipeline.run()
+    return pipeline.stats
+
+
+def split_segments(start, end, segment_num, keyframe_index=None):
+    """split [start, end] into at most segment_num segments, starting at
+    keyframes if a KeyframeIndex is given
+    """
+    length = end - start + 1
+    bounds = [start]
+    for i in range(1, segment_num):
+        bound = start + int(round(i * length / segment_num))
+        if keyframe_index is not None:
+            keyframe = keyframe_index.nearest_keyframe(bound)
+            if keyframe is not None:
+                bound = keyframe
+        if bounds[-1] < bound <= end:
+            bounds.append(bound)
+    bounds.append(end + 1)
+    return [(bounds[i], bounds[i + 1] - 1) for i in range(len(bounds) - 1)]
+
+
+def _export_segment_worker(args):
+    (video_file, out_file, overlays, start, end, fourcc, scale,
+     progress_queue, subtitle) = args
+    return export_segment(video_file, out_file, overlays, start, end, fourcc,
+                          scale, progress_queue.put, subtitle=subtitle)
+
+
+def concat_segments(segment_files, out_file, fourcc='XVID'):
+    """concatenate segments without re-encoding if ffmpeg is available,
+    otherwise decode and encode them again with OpenCV
+    """
+    list_file = out_file + '.segments.txt'
+    with open(list_file, 'w') as fout:
+        for filename in segment_files:
+            fout.write("file '{}'\n".format(os.path.abspath(filename)))
+    try:
+        subprocess.check_call(
+            ('ffmpeg', '-v', 'error', '-y', '-f', 'concat', '-safe', '0',
+             '-i', list_file, '-c', 'copy', out_file))
+        return
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    finally:
+        os.remove(list_file)
+    vwriter = None
+    for filename in segment_files:
+        cap = cv2.VideoCapture(filename)
+        if vwriter is None:
+            size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                    int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+            vwriter = cv2.VideoWriter(out_file,
+                                      cv2.VideoWriter_fourcc(*fourcc),
+                                      cap.get(cv2.CAP_PROP_FPS), size)
+        ret, img = cap.read()
+        while ret:
+            vwriter.write(img)
+            ret, img = cap.read()
+        cap.release()
+    if vwriter is not None:
+        vwriter.release()
+
+
+def merge_stats(stats_list):
+    stats = {stage: dict(frames=0, seconds=0.0)
+             for stage in ExportPipeline.stages}
+    for _stats in stats_list:
+        for stage, stat in _stats.items():
+            stats[stage]['frames'] += stat['frames']
+            stats[stage]['seconds'] += stat['seconds']
+    return stats
+
+
+def summarize(stats, seconds, cancelled):
+    """frames written, wall time, overall and per-stage frames/s"""
+    frames = stats['encode']['frames']
+    summary = dict(frames=frames, seconds=seconds, cancelled=cancelled,
+                   fps=frames / seconds if seconds > 0 else 0.0)
+    for stage, stat in stats.items():
+        summary[stage + '_fps'] = (stat['frames'] / stat['seconds']
+                                   if stat['seconds'] > 0 else 0.0)
+    return summary
+
+
+def export_parallel(video_file, out_file, annotation, start=1, end=0,
+                    worker_num=None, fourcc='XVID', scale=1.0, progress=None,
+                    keyframe_index=None, cancel_event=None, subtitle=None):
+    """export a video with bounding boxes using a pool of processes
+
+    The frame range is split into segments at keyframes, every worker
+    decodes and encodes its own segment and the segments are concatenated
+    at the end. progress(percent) is called from the calling thread.
+    Setting cancel_event terminates the workers. Every worker only gets
+    the subtitle cues of its segment.
+    """
+    start_time = time.time()
+    if worker_num is None:
+        worker_num = multiprocessing.cpu_count()
+    end = end if end > 0 else frame_count(video_file)
+    fps = video_fps(video_file) if subtitle is not None else 0
+    export_num = end - start + 1
+    segments = split_segments(start, end, worker_num, keyframe_index)
+    tmp_dir = tempfile.mkdtemp(
+        dir=os.path.dirname(os.path.abspath(out_file)))
+    ext = os.path.splitext(out_file)[1]
+    segment_files = [os.path.join(tmp_dir, '{:04d}{}'.format(i, ext))
+                     for i in range(len(segments))]
+    # do not fork, the caller may be a multi-threaded Qt application
+    context = multiprocessing.get_context('spawn')
+    manager = context.Manager()
+    progress_queue = manager.Queue()
+    tasks = [(video_file, segment_file,
+              get_overlays(annotation, seg_start, seg_end),
+              seg_start, seg_end, fourcc, scale, progress_queue,
+              subtitle.slice((seg_start - 1) / fps, seg_end / fps)
+              if subtitle is not None else None)
+             for segment_file, (seg_start, seg_end)
+             in zip(segment_files, segments)]
+    completed = 0
+    cancelled = False
+    stats_list = []
+    try:
+        with context.Pool(min(worker_num, len(segments))) as pool:
+            result = pool.map_async(_export_segment_worker, tasks)
+            while not result.ready() or not progress_queue.empty():
+                if cancel_event is not None and cancel_event.is_set():
+                    pool.terminate()
+                    cancelled = True
+                    break
+                try:
+                    completed += progress_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if progress is not None:
+                    progress(int(round(100 * completed / export_num)))
+            if not cancelled:
+                stats_list = result.get()
+        if not cancelled:
+            concat_segments(segment_files, out_file, fourcc)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        manager.shutdown()
+    return summarize(merge_stats(stats_list), time.time() - start_time,
+                     cancelled)
+
+
+def export_video(video_file, out_file, annotation, start=1, end=0,
+                 worker_num=1, fourcc='XVID', scale=1.0, progress=None,
+                 keyframe_index=None, cancel_event=None, subtitle=None):
+    """export a video with bounding boxes (and a Subtitle if given), does
+    not depend on Qt
+
+    progress(percent) is called as frames are written and setting
+    cancel_event stops the export. Return a summary with the number of
+    written frames and the throughput of the whole export and every stage.
+    """
+    end = end if end > 0 else frame_count(video_file)
+    if worker_num != 1:
+        return export_parallel(video_file, out_file, annotation, start, end,
+                               worker_num, fourcc, scale, progress,
+                               keyframe_index, cancel_event, subtitle)
+    start_time = time.time()
+    export_num = end - start + 1
+    completed = [0]
+
+    def on_progress(frame_num):
+        completed[0] += frame_num
+        if progress is not None:
+            progress(int(round(100 * completed[0] / export_num)))
+
+    stats = export_segment(video_file, out_file,
+                           get_overlays(annotation, start, end), start, end,
+                           fourcc, scale, on_progress, cancel_event,
+                           subtitle)
+    cancelled = cancel_event is not None and cancel_event.is_set()
+    return summarize(stats, time.time() - start_time, cancelled)
@@ -4,12 +4,13 @@ from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 
-from bbox import BoundingBox
+from bbox import BoundingBox, SRC_KEYFRAME
 
 
 class ImageLabel(QLabel):
     bbox_added = pyqtSignal(BoundingBox)
     bbox_deleted = pyqtSignal()
+    resized = pyqtSignal(int, int)
 
     def __init__(self, *args):
         super(ImageLabel, self).__init__(*args)
@@ -67,6 +68,10 @@ class ImageLabel(QLabel):
             self.repaint()
             time.sleep(0.07)
 
+    def resizeEvent(self, event):
+        super(ImageLabel, self).resizeEvent(event)
+        self.resized.emit(self.width() - 2, self.height() - 2)
+
     def paintEvent(self, event):
         super(ImageLabel, self).paintEvent(event)
         painter = QPainter()
@@ -102,7 +107,8 @@ class ImageLabel(QLabel):
                             self.bboxes['other_tubes'].append(
                                 self.bboxes['current_tube'])
                         self.is_new_tube = False
-                    bbox = BoundingBox.from_qrect(rect, self.bbox_label, 1)
+                    bbox = BoundingBox.from_qrect(rect, self.bbox_label,
+                                                  SRC_KEYFRAME)
                     self.bboxes['current_tube'] = bbox
                     self.bbox_added.emit(self.proj_to_real_img(bbox))
             self.update()
@@ -135,11 +141,11 @@ class ImageLabel(QLabel):
             self.show_reticle = not self.show_reticle
         self.update()
 
-    def display(self, pixmap):
-        self.scale_ratio = max(pixmap.width() / self.width(),
-                               pixmap.height() / self.height())
-        scaled_pixmap = pixmap.scaled(self.width() - 2, self.height() - 2,
-                                      Qt.KeepAspectRatio)
+    def display(self, frame):
+        self.scale_ratio = max(frame.width / self.width(),
+                               frame.height / self.height())
+        scaled_pixmap = frame.scaled_pixmap(self.width() - 2,
+                                            self.height() - 2)
         x = int((self.width() - scaled_pixmap.width()) / 2)
         y = int((self.height() - scaled_pixmap.height()) / 2)
         self.img_region = BoundingBox.from_qrect(
@@ -0,0 +1,97 @@
+from collections import defaultdict
+
+
+class IntervalIndex(object):
+    """index of closed intervals [start, end] keyed by id
+
+    The frame axis is split into buckets of `bucket_size` frames and every
+    interval is registered in the buckets it overlaps, so a query only
+    looks at the intervals sharing a bucket with it. Extending an interval
+    (which happens on every tracked frame) only touches the new buckets.
+    """
+
+    def __init__(self, bucket_size=256):
+        self.bucket_size = bucket_size
+        self._intervals = dict()
+        self._buckets = defaultdict(set)
+
+    def __len__(self):
+        return len(self._intervals)
+
+    def __contains__(self, key):
+        return key in self._intervals
+
+    def _bucket_range(self, start, end):
+        return (start // self.bucket_size, end // self.bucket_size)
+
+    def _add_buckets(self, key, first, last):
+        for i in range(first, last + 1):
+            self._buckets[i].add(key)
+
+    def _del_buckets(self, key, first, last):
+        for i in range(first, last + 1):
+            bucket = self._buckets[i]
+            bucket.discard(key)
+            if not bucket:
+                del self._buckets[i]
+
+    def add(self, key, start, end):
+        if key in self._intervals:
+            self.update(key, start, end)
+            return
+        self._intervals[key] = (start, end)
+        self._add_buckets(key, *self._bucket_range(start, end))
+
+    def update(self, key, start, end):
+        if key not in self._intervals:
+            self.add(key, start, end)
+            return
+        old_first, old_last = self._bucket_range(*self._intervals[key])
+        first, last = self._bucket_range(start, end)
+        self._intervals[key] = (start, end)
+        if old_last < first or last < old_first:
+            self._del_buckets(key, old_first, old_last)
+            self._add_buckets(key, first, last)
+            return
+        self._add_buckets(key, first, old_first - 1)
+        self._add_buckets(key, old_last + 1, last)
+        self._del_buckets(key, old_first, first - 1)
+        self._del_buckets(key, last + 1, old_last)
+
+    def remove(self, key):
+        if key not in self._intervals:
+            return
+        self._del_buckets(key, *self._bucket_range(*self._intervals.pop(key)))
+
+    def clear(self):
+        self._intervals.clear()
+        self._buckets.clear()
+
+    def query(self, frame_id):
+        """sorted ids of the intervals containing frame_id"""
+        bucket = self._buckets.get(frame_id // self.bucket_size, ())
+        keys = []
+        for key in bucket:
+            start, end = self._intervals[key]
+            if start <= frame_id <= end:
+                keys.append(key)
+        keys.sort()
+        return keys
+
+    def query_range(self, start, end):
+        """sorted ids of the intervals overlapping [start, end]"""
+        first, last = self._bucket_range(start, end)
+        if last - first + 1 > len(self._intervals):
+            candidates = self._intervals
+        else:
+            candidates = set()
+            for i in range(first, last + 1):
+                if i in self._buckets:
+                    candidates.update(self._buckets[i])
+        keys = []
+        for key in candidates:
+            _start, _end = self._intervals[key]
+            if _start <= end and _end >= start:
+                keys.append(key)
+        keys.sort()
+        return keys
@@ -0,0 +1,114 @@
+import json
+import os
+import queue
+import threading
+import time
+
+_COMPACT = 'compact'
+_STOP = 'stop'
+
+
+def read_journal(filename):
+    """read the records of a journal file, a truncated last line (e.g. after
+    a crash) is ignored
+    """
+    records = []
+    if not os.path.isfile(filename):
+        return records
+    with open(filename, 'r') as fin:
+        for line in fin:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+    return records
+
+
+class AnnotationJournal(object):
+    """append-only journal of the mutations of an annotation
+
+    Records are written in batches by a background thread to
+    <annotation file>.journal. The journal is folded into the annotation
+    file (compaction) periodically, when it gets long or on request.
+    Every record has a sequence number and the annotation file stores the
+    last one it contains, so a crash between writing the annotation file and
+    truncating the journal only replays newer records.
+    """
+
+    def __init__(self, annotation, batch_interval=0.5, compact_interval=60,
+                 compact_size=5000):
+        self.annotation = annotation
+        self.filename = annotation.filename + '.journal'
+        self.batch_interval = batch_interval
+        self.compact_interval = compact_interval
+        self.compact_size = compact_size
+        self.record_num = len(read_journal(self.filename))
+        self._compacted_seq = annotation.seq
+        self._last_compaction = time.time()
+        self._queue = queue.Queue()
+        self._fout = open(self.filename, 'a')
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def append(self, record):
+        self._queue.put(record)
+
+    def flush(self):
+        """block until all appended records are written"""
+        self._queue.join()
+
+    def compact(self, wait=False):
+        self._queue.put(_COMPACT)
+        if wait:
+            self.flush()
+
+    def close(self, compact=True):
+        if compact:
+            self._queue.put(_COMPACT)
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    def _write(self, records):
+        lines = [json.dumps(record) + '\n' for record in records
+                 if record['seq'] > self._compacted_seq]
+        if not lines:
+            return
+        self._fout.write(''.join(lines))
+        self._fout.flush()
+        os.fsync(self._fout.fileno())
+        self.record_num += len(lines)
+
+    def _compact(self):
+        self._compacted_seq = self.annotation.write()
+        self._fout.close()
+        self._fout = open(self.filename, 'w')
+        self.record_num = 0
+        self._last_compaction = time.time()
+
+    def _run(self):
+        while True:
+            try:
+                items = [self._queue.get(timeout=self.batch_interval)]
+            except queue.Empty:
+                items = []
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write([item for item in items if isinstance(item, dict)])
+            if (_COMPACT in items or self.record_num >= self.compact_size or
+                    (self.record_num > 0 and time.time() -
+                     self._last_compaction > self.compact_interval)):
+                try:
+                    self._compact()
+                except OSError as err:
+                    # the records are still in the journal, retry later
+                    print('failed to compact the journal:', err)
+                    self._last_compaction = time.time()
+            for _ in items:
+                self._queue.task_done()
+            if _STOP in items:
+                self._fout.close()
+                return
@@ -0,0 +1,104 @@
+import json
+import os
+import subprocess
+import threading
+from bisect import bisect_right
+
+
+class KeyframeIndex(object):
+    """keyframe and pts index of a video, persisted as <video>.index
+
+    Frame ids are 1-based like the cursor of `Video`. The sidecar is
+    rebuilt when the size or mtime of the video changes.
+    """
+
+    def __init__(self, video_file):
+        self.video_file = video_file
+        self.index_file = video_file + '.index'
+        self.keyframes = []
+        self.pts = []
+        self.ready = False
+
+    def __len__(self):
+        return len(self.keyframes)
+
+    def _file_stat(self):
+        stat = os.stat(self.video_file)
+        return stat.st_size, stat.st_mtime
+
+    def load(self):
+        if not os.path.isfile(self.index_file):
+            return False
+        try:
+            with open(self.index_file, 'r') as fin:
+                data = json.load(fin)
+        except ValueError:
+            return False
+        size, mtime = self._file_stat()
+        if data.get('size') != size or data.get('mtime') != mtime:
+            return False
+        self.keyframes = data['keyframes']
+        self.pts = data['pts']
+        self.ready = len(self.keyframes) > 0
+        return True
+
+    def save(self):
+        size, mtime = self._file_stat()
+        data = dict(size=size, mtime=mtime, keyframes=self.keyframes,
+                    pts=self.pts)
+        tmp_file = self.index_file + '.tmp'
+        with open(tmp_file, 'w') as fout:
+            json.dump(data, fout)
+        os.replace(tmp_file, self.index_file)
+
+    def probe(self):
+        """read the packet pts and flags of the first video stream
+        packets are not decoded, so this is much faster than a full pass
+        """
+        try:
+            output = subprocess.check_output(
+                ('ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                 '-show_entries', 'packet=pts_time,flags', '-of',
+                 'compact=p=0', self.video_file))
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        packets = []
+        for line in output.decode('utf-8').split('\n'):
+            fields = dict(item.split('=', 1) for item in line.split('|')
+                          if '=' in item)
+            if 'pts_time' not in fields or fields['pts_time'] == 'N/A':
+                continue
+            packets.append((float(fields['pts_time']),
+                            'K' in fields.get('flags', '')))
+        # packets are in decoding order, frame ids follow presentation order
+        packets.sort()
+        return packets
+
+    def build(self):
+        packets = self.probe()
+        if not packets:
+            return False
+        self.pts = [pts for pts, _ in packets]
+        self.keyframes = [i + 1 for i, (_, is_key) in enumerate(packets)
+                          if is_key]
+        self.save()
+        self.ready = len(self.keyframes) > 0
+        return True
+
+    def load_or_build(self):
+        if not self.load():
+            self.build()
+
+    def load_or_build_async(self):
+        t = threading.Thread(target=self.load_or_build)
+        t.daemon = True
+        t.start()
+
+    def nearest_keyframe(self, frame_id):
+        """the last keyframe at or before frame_id, None if unknown"""
+        if not self.ready:
+            return None
+        idx = bisect_right(self.keyframes, frame_id)
+        if idx == 0:
+            return None
+        return self.keyframes[idx - 1]
@@ -18,6 +18,8 @@ class MainWindow(QMainWindow):
         self.action_open.triggered.connect(self.video_widget.open_file)
         self.action_save.triggered.connect(self.video_widget.save_annotation)
         self.action_export.triggered.connect(self.video_widget.export_video)
+        self.action_cancel_export.triggered.connect(
+            self.video_widget.cancel_export)
         # video widget signals
         self.video_widget.annotation_loaded.connect(
             self.annotation_widget.show_tubes)
@@ -26,6 +28,9 @@ class MainWindow(QMainWindow):
             self.annotation_widget.add_tube)
         self.video_widget.export_progress_updated.connect(
             self.update_export_progress)
+        self.video_widget.export_finished.connect(self.show_export_summary)
+        self.video_widget.tubes_propagated.connect(
+            self.show_propagation_summary)
         # annotation widget signals
         self.annotation_widget.combobox_word.currentTextChanged.connect(
             self.video_widget.update_bbox_label)
@@ -74,6 +79,9 @@ class MainWindow(QMainWindow):
         self.action_export = QAction('&Export', menubar)
         self.action_export.setShortcut('Ctrl+E')
         menu_file.addAction(self.action_export)
+        self.action_cancel_export = QAction('&Cancel Export', menubar)
+        self.action_cancel_export.setShortcut('Ctrl+Shift+E')
+        menu_file.addAction(self.action_cancel_export)
 
     def init_statusbar(self):
         statusbar = self.statusBar()
@@ -84,6 +92,10 @@ class MainWindow(QMainWindow):
         statusbar.addWidget(self.label_frame_idx)
         statusbar.addPermanentWidget(self.progressbar_export)
 
+    def closeEvent(self, event):
+        self.video_widget.annotation.close()
+        super(MainWindow, self).closeEvent(event)
+
     @pyqtSlot(int)
     def update_frame_id(self, frame_id):
         total_num = self.video_widget.frame_cnt()
@@ -95,6 +107,29 @@ class MainWindow(QMainWindow):
             self.progressbar_export.setVisible(True)
         self.progressbar_export.setValue(progress)
 
+    @pyqtSlot(dict)
+    def show_export_summary(self, summary):
+        self.progressbar_export.setVisible(False)
+        self.statusBar().showMessage(
+            'Export {}: {} frames, {:.1f} fps (decode {:.1f}, overlay {:.1f},'
+            ' encode {:.1f} fps)'.format(
+                'cancelled' if summary['cancelled'] else 'finished',
+                summary['frames'], summary['fps'], summary['decode_fps'],
+                summary['overlay_fps'], summary['encode_fps']), 10000)
+
+    @pyqtSlot(dict)
+    def show_propagation_summary(self, result):
+        if 'error' in result:
+            self.statusBar().showMessage(
+                'Propagation failed: {}'.format(result['error']), 10000)
+            return
+        frames = set()
+        for tube_frames in result['low_confidence'].values():
+            frames.update(tube_frames)
+        self.statusBar().showMessage(
+            'Propagated {} tubes, {} frames to review (N)'.format(
+                len(result['last_frames']), len(frames)), 10000)
+
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
@@ -9,19 +9,23 @@ from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 
-from video import Video
+from subtitle import Subtitle, WordIndex, find_subtitle
+from video import Video, VideoFrame, VideoStatus
 
 
 class VideoWidget(QWidget):
-    signal_play_option = pyqtSignal(int)
     signal_video_loaded = pyqtSignal(str)
+    frame_updated = pyqtSignal(int)
 
-    def __init__(self, parent=None, max_buf_size=500):
+    def __init__(self, parent=None, cache_capacity=500, max_fps=None):
         super(VideoWidget, self).__init__(parent)
-        self.video = Video(max_buf_size=max_buf_size)
-        self.max_buf_size = max_buf_size
+        # max_fps None plays the video at its own fps
+        self.max_fps = max_fps
+        self.video = Video(cache_capacity=cache_capacity,
+                           max_fps=max_fps or 0)
         self.init_ui()
         self.slider.sliderReleased.connect(self.on_slider_released)
+        self.video.frame_updated.connect(self.update_frame)
         self.installEventFilter(self)
 
     def init_ui(self):
@@ -54,37 +58,43 @@ class VideoWidget(QWidget):
         self.label_frame.setStyleSheet('border: 1px solid black')
         self.grid_layout.addWidget(self.label_frame, 1, 0)
 
+    def resizeEvent(self, event):
+        super(VideoWidget, self).resizeEvent(event)
+        # frames are downscaled to the label size once and cached
+        self.video.set_display_size(self.label_frame.width() - 2,
+                                    self.label_frame.height() - 2)
+
     def eventFilter(self, object, event):
         if event.type() == QEvent.KeyPress:
             key = event.key()
-            print('key pressed in video filter ', object, key)
             if key == Qt.Key_D:
-                self.video.next_frame()
+                self.update_frame(self.video.frame_forward())
                 return True
             elif key == Qt.Key_A:
-                self.video.last_frame()
+                self.update_frame(self.video.frame_backward())
                 return True
             elif key == Qt.Key_Left:
-                if self.video.play_status >= 0:
-                    self.signal_play_option.emit(-1)
-                else:
-                    self.signal_play_option.emit(0)
+                if self.video.status == VideoStatus.play_backward:
+                    self.video.pause()
+                elif self.video.status != VideoStatus.not_loaded:
+                    self.video.play_backward()
                 return True
             elif key == Qt.Key_Right:
-                if self.video.play_status <= 0:
-                    self.signal_play_option.emit(1)
-                else:
-                    self.signal_play_option.emit(0)
+                if self.video.status == VideoStatus.play_forward:
+                    self.video.pause()
+                elif self.video.status != VideoStatus.not_loaded:
+                    self.video.play_forward()
                 return True
             elif key == Qt.Key_Space:
-                self.video.play_status = 0
+                self.video.pause()
                 return True
-            else:
-                print('send to parent ', self.parent())
-                print('send to parent\'s parent ', self.parent().parent())
-                return False
-        else:
-            return False
+        return False
+
+    def cursor(self):
+        return self.video.cursor
+
+    def frame_cnt(self):
+        return self.video.frame_cnt
 
     @pyqtSlot()
     def open_file(self):
@@ -92,47 +102,50 @@ class VideoWidget(QWidget):
             self, 'Load video', './', 'Videos (*.mp4 *.avi *.mkv *.flv *.m4v)')
         if not self.filename:
             return
-        disp_name = os.path.basename(self.filename)
-        self.label_filename.setText(os.path.basename(disp_name))
+        self.label_filename.setText(os.path.basename(self.filename))
         self.video.load(self.filename)
-        self.signal_play_option.connect(self.video.play_ctl)
-        self.video.signal_frame_updated.connect(self.update_frame)
-        self.video.next_frame()
+        if self.max_fps is None:
+            self.video.max_fps = self.video.fps
         self.slider.setEnabled(True)
+        self.jump_to_frame(1)
         self.signal_video_loaded.emit(self.filename)
 
-    @pyqtSlot(QPixmap)
-    def update_frame(self, pixmap):
-        frame_cursor = self.video.frame_cursor
-        frame_num = self.video.frame_num
+    @pyqtSlot(VideoFrame)
+    def update_frame(self, frame):
+        if frame is None:
+            return
         self.label_frame.setPixmap(
-            pixmap.scaled(self.label_frame.width() - 2,
-                          self.label_frame.height() - 2,
-                          Qt.KeepAspectRatio))
-        self.label_frame.update()
-        self.slider.setValue(int(frame_cursor * self.slider.maximum() / frame_num))
+            frame.scaled_pixmap(self.label_frame.width() - 2,
+                                self.label_frame.height() - 2))
+        self.slider.setValue(
+            int(self.slider.maximum() * frame.id / self.frame_cnt()))
+        self.frame_updated.emit(frame.id)
 
     @pyqtSlot()
     def on_slider_released(self):
-        self.video.play_status = 0
-        cursor = int(self.video.frame_num * self.slider.value() / self.slider.maximum())
-        self.video.set_pos(cursor)
+        progress = self.slider.value() / self.slider.maximum()
+        self.jump_to_frame(max(int(round(self.frame_cnt() * progress)), 1))
 
     @pyqtSlot(int)
     def jump_to_frame(self, cursor):
-        self.video.play_status = 0
-        self.video.set_pos(cursor)
+        self.update_frame(self.video.jump_to_frame(cursor))
 
 
 class AnnotationWidget(QWidget):
     signal_frame_selected = pyqtSignal(int)
+    # number of subtitle slots listed for a word
+    max_slots = 200
 
     def __init__(self, parrent=None):
         super(AnnotationWidget, self).__init__(parrent)
         self.annotation = {}
+        # word -> frame slots of the subtitle cues, None without subtitles
+        self.word_index = None
         self.init_ui()
         self.list_widget.itemDoubleClicked.connect(self.on_item_double_clicked)
         self.lineedit_word.returnPressed.connect(self.add_word)
+        self.lineedit_word.textChanged.connect(self.suggest_slots)
+        self.combobox_slots.activated.connect(self.select_slot)
         # self.installEventFilter(self)
 
     def init_ui(self):
@@ -149,6 +162,7 @@ class AnnotationWidget(QWidget):
         self.lineedit_end = QLineEdit()
         self.lineedit_end.setReadOnly(True)
         self.lineedit_word = QLineEdit()
+        self.combobox_slots = QComboBox()
         self.grid_layout.addWidget(self.list_widget, 0, 0, 11, 2)
         self.grid_layout.addWidget(self.label_start, 11, 0, 1, 1)
         self.grid_layout.addWidget(self.label_end, 12, 0, 1, 1)
@@ -156,6 +170,7 @@ class AnnotationWidget(QWidget):
         self.grid_layout.addWidget(self.lineedit_end, 12, 1, 1, 1)
         self.grid_layout.addWidget(self.combobox, 13, 0, 1, 1)
         self.grid_layout.addWidget(self.lineedit_word, 13, 1, 1, 1)
+        self.grid_layout.addWidget(self.combobox_slots, 14, 0, 1, 2)
         self.setLayout(self.grid_layout)
 
     def keyPressEvent(self, event):
@@ -173,6 +188,34 @@ class AnnotationWidget(QWidget):
     def set_end(self, end):
         self.lineedit_end.setText(str(end))
 
+    def set_word_index(self, word_index):
+        self.word_index = word_index
+        self.combobox_slots.clear()
+
+    @pyqtSlot(str)
+    def suggest_slots(self, text):
+        """list the subtitle slots containing the typed word, start and end
+        are pre-filled with the first one only if they are not set yet
+        """
+        self.combobox_slots.clear()
+        if self.word_index is None or text.strip() == '':
+            return
+        for start, end in self.word_index.lookup(text, self.max_slots):
+            self.combobox_slots.addItem('{} - {}'.format(start, end),
+                                        (start, end))
+        if (self.combobox_slots.count() > 0 and
+                self.lineedit_start.text() == '' and
+                self.lineedit_end.text() == ''):
+            self.select_slot(0, jump=False)
+
+    @pyqtSlot(int)
+    def select_slot(self, idx, jump=True):
+        start, end = self.combobox_slots.itemData(idx)
+        self.set_start(start)
+        self.set_end(end)
+        if jump:
+            self.signal_frame_selected.emit(start)
+
     def add_annotation(self, word, start, end):
         if word not in self.annotation:
             self.annotation[word] = []
@@ -235,7 +278,8 @@ class MainWindow(QMainWindow):
         self.show()
         self.action_open.triggered.connect(self.video_widget.open_file)
         self.video_widget.signal_video_loaded.connect(self.annotation_widget.load_annotation)
-        self.video_widget.video.signal_frame_updated.connect(self.update_statusbar)
+        self.video_widget.signal_video_loaded.connect(self.load_word_index)
+        self.video_widget.frame_updated.connect(self.update_statusbar)
         self.annotation_widget.signal_frame_selected.connect(self.video_widget.jump_to_frame)
         self.annotation_widget.installEventFilter(self)
 
@@ -280,10 +324,10 @@ class MainWindow(QMainWindow):
             key = event.key()
             if key == Qt.Key_S:
                 print('S', ...)
-                self.annotation_widget.set_start(self.video_widget.video.frame_cursor)
+                self.annotation_widget.set_start(self.video_widget.cursor())
                 return True
             elif key == Qt.Key_T:
-                self.annotation_widget.set_end(self.video_widget.video.frame_cursor)
+                self.annotation_widget.set_end(self.video_widget.cursor())
                 return True
             elif key == Qt.Key_Enter or key == Qt.Key_Return:
                 if self.annotation_widget.lineedit_word.hasFocus():
@@ -316,6 +360,22 @@ class MainWindow(QMainWindow):
     #             print(time_slot)
     #             self.annotation[word].remove(time_slot)
 
+    @pyqtSlot(str)
+    def load_word_index(self, filename):
+        subtitle_file = find_subtitle(filename)
+        if subtitle_file is None:
+            self.annotation_widget.set_word_index(None)
+            return
+        try:
+            subtitle = Subtitle(subtitle_file)
+        except (OSError, ValueError) as err:
+            self.annotation_widget.set_word_index(None)
+            QMessageBox.warning(self, 'Subtitle', 'Cannot load {}: {}'.format(
+                subtitle_file, err))
+            return
+        self.annotation_widget.set_word_index(
+            WordIndex(subtitle, self.video_widget.video.fps))
+
     def add_annotation(self):
         word = self.annotation_widget.combobox.currentText()
         if word.strip() == '':
@@ -324,12 +384,10 @@ class MainWindow(QMainWindow):
         end = int(self.annotation_widget.lineedit_end.text())
         self.annotation_widget.add_annotation(word, start, end)
 
-    @pyqtSlot(QPixmap)
-    def update_statusbar(self, pixmap):
-        frame_cursor = self.video_widget.video.frame_cursor
-        frame_num = self.video_widget.video.frame_num
+    @pyqtSlot(int)
+    def update_statusbar(self, frame_id):
         self.statusBar().showMessage(' Frame {}/{}'.format(
-            frame_cursor, frame_num))
+            frame_id, self.video_widget.frame_cnt()))
 
 
 if __name__ == '__main__':
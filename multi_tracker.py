@@ -0,0 +1,213 @@
+import multiprocessing
+import queue
+from collections import defaultdict
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from bbox import BoundingBox, SRC_TRACKED
+from ckutils.video import VideoReader
+from drift import DriftDetector, low_confidence
+from tracker import Tracker, TrackFrame
+
+
+def open_tubes(annotation, frame_id):
+    """ids of the tubes which end with a bounding box at frame_id"""
+    tube_ids = []
+    with annotation.lock:
+        for tube_id in annotation.index.query(frame_id):
+            if (annotation.tube_end(tube_id) == frame_id and
+                    annotation.get_bbox(tube_id, frame_id) is not None):
+                tube_ids.append(tube_id)
+    return tube_ids
+
+
+def _track_worker(shm_name, shape, tubes, sim_thr, hist_bins, downscale,
+                  grayscale, task_queue, result_queue):
+    """track a shard of tubes on the frames in shared memory
+
+    tubes is a list of (tube_id, rect) at the first frame. For every
+    (frame_id, slot) task, a list of (tube_id, rect, similarity) is put
+    into the result queue, rect is None when the tube is lost. The drift
+    of all trackers of the shard is checked at once.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    frames = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    img = None
+    trackers = None
+    drift = DriftDetector(hist_bins)
+    frame_rect = BoundingBox(None, 0, 0, 0, shape[2], shape[1])
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        frame_id, slot = task
+        img = frames[slot]
+        results = []
+        if trackers is None:
+            trackers = dict()
+            for tube_id, rect in tubes:
+                bbox = BoundingBox(None, SRC_TRACKED, *rect)
+                tracker = Tracker(downscale, grayscale)
+                tracker.start_track(TrackFrame(frame_id, img), bbox)
+                trackers[tube_id] = tracker
+                drift.set_reference(tube_id, img, bbox)
+        else:
+            bboxes = dict()
+            for tube_id, tracker in trackers.items():
+                bbox, _ = tracker.update(TrackFrame(frame_id, img))
+                bboxes[tube_id] = bbox.intersected(frame_rect)
+            sims = drift.update(frame_id, img, bboxes)
+            for tube_id, bbox in bboxes.items():
+                if sims[tube_id] < sim_thr:
+                    del trackers[tube_id]
+                    results.append((tube_id, None, sims[tube_id]))
+                else:
+                    results.append((tube_id, list(bbox), sims[tube_id]))
+        result_queue.put((frame_id, results))
+    del img, frames
+    shm.close()
+
+
+class MultiTracker(object):
+    """propagate many tubes at once with a pool of tracking processes
+
+    Every frame is decoded once and copied into a ring of `slot_num` frame
+    slots in shared memory. The tubes are sharded across the workers, which
+    read the frames from the slots, and the tracked boxes are written back
+    into the annotation with the tracked source. The similarity of every
+    tracked box to the first one is kept in `scores`.
+    """
+
+    def __init__(self, video_file, worker_num=None, slot_num=8, sim_thr=0.9,
+                 hist_bins=16, downscale=False, grayscale=False):
+        self.video_file = video_file
+        self.worker_num = (worker_num if worker_num is not None else
+                           multiprocessing.cpu_count())
+        self.slot_num = slot_num
+        self.sim_thr = sim_thr
+        self.hist_bins = hist_bins
+        self.downscale = downscale
+        self.grayscale = grayscale
+        # tube id -> {frame id: similarity} of the last propagation
+        self.scores = defaultdict(dict)
+
+    def low_confidence(self, sim_thr):
+        """tube id -> sorted frames tracked with a similarity below sim_thr
+        in the last propagation, tubes without such frames are left out
+        """
+        frames = dict()
+        for tube_id, scores in self.scores.items():
+            tube_frames = low_confidence(scores, sim_thr)
+            if tube_frames:
+                frames[tube_id] = tube_frames
+        return frames
+
+    def propagate(self, annotation, frame_id, frame_num, tube_ids=None,
+                  progress=None, cancel_event=None):
+        """track the tubes from frame_id for at most frame_num frames
+
+        tube_ids defaults to the open tubes at frame_id. progress(frame_id)
+        is called when a frame is done. Return a dict from tube id to the
+        last tracked frame. Raise RuntimeError if a tracking process dies.
+        """
+        if tube_ids is None:
+            tube_ids = open_tubes(annotation, frame_id)
+        self.scores.clear()
+        last_frames = {tube_id: frame_id for tube_id in tube_ids}
+        if not tube_ids:
+            return last_frames
+        labels = {tube_id: annotation.tube(tube_id).label
+                  for tube_id in tube_ids}
+        vreader = VideoReader(self.video_file)
+        ret, img = vreader.get_frame(frame_id)
+        if not ret:
+            vreader.release()
+            return last_frames
+        shape = (self.slot_num, ) + img.shape
+        shm = shared_memory.SharedMemory(create=True,
+                                         size=int(np.prod(shape)))
+        frames = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        worker_num = min(self.worker_num, len(tube_ids))
+        shards = [[] for _ in range(worker_num)]
+        for i, tube_id in enumerate(tube_ids):
+            rect = list(annotation.get_bbox(tube_id, frame_id))
+            shards[i % worker_num].append((tube_id, rect))
+        # do not fork, the caller may be a multi-threaded Qt application
+        context = multiprocessing.get_context('spawn')
+        result_queue = context.Queue()
+        task_queues = [context.Queue() for _ in range(worker_num)]
+        workers = [
+            context.Process(target=_track_worker,
+                            args=(shm.name, shape, shard, self.sim_thr,
+                                  self.hist_bins, self.downscale,
+                                  self.grayscale, task_queue, result_queue))
+            for shard, task_queue in zip(shards, task_queues)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        alive = set(tube_ids)
+        # number of workers which have not finished a frame yet
+        pending = dict()
+
+        def collect():
+            # a crashed worker never reports its frames, do not wait forever
+            while True:
+                try:
+                    done_frame, results = result_queue.get(timeout=1)
+                    break
+                except queue.Empty:
+                    for worker in workers:
+                        if not worker.is_alive():
+                            raise RuntimeError(
+                                'tracking process exited with code '
+                                '{}'.format(worker.exitcode))
+            pending[done_frame] -= 1
+            if pending[done_frame] == 0:
+                del pending[done_frame]
+                if progress is not None:
+                    progress(done_frame)
+            for tube_id, rect, sim in results:
+                self.scores[tube_id][done_frame] = sim
+                with annotation.lock:
+                    # the tube may have been deleted in the meantime
+                    if rect is None or annotation.tube(tube_id) is None:
+                        alive.discard(tube_id)
+                        continue
+                    annotation.set_bbox(
+                        tube_id, done_frame,
+                        BoundingBox(labels[tube_id], SRC_TRACKED, *rect))
+                last_frames[tube_id] = done_frame
+
+        try:
+            for i in range(frame_num + 1):
+                if i > 0:
+                    if cancel_event is not None and cancel_event.is_set():
+                        break
+                    ret, img = vreader.read()
+                    if not ret:
+                        break
+                # wait until the slot is no longer used by any worker
+                while frame_id + i - self.slot_num in pending:
+                    collect()
+                if not alive:
+                    break
+                slot = i % self.slot_num
+                frames[slot] = img
+                pending[frame_id + i] = worker_num
+                for task_queue in task_queues:
+                    task_queue.put((frame_id + i, slot))
+            while pending:
+                collect()
+        finally:
+            for task_queue in task_queues:
+                task_queue.put(None)
+            for worker in workers:
+                worker.join(timeout=1)
+                if worker.is_alive():
+                    worker.terminate()
+            vreader.release()
+            del frames
+            shm.close()
+            shm.unlink()
+        return last_frames
@@ -0,0 +1,52 @@
+import threading
+from bisect import bisect_left, bisect_right
+
+from video_splitter import VideoSplitter
+
+
+class SceneIndex(object):
+    """sorted scene cuts of a video
+
+    The sections are read from the <video>.cfg cache of `VideoSplitter`,
+    or computed in the background (with ffprobe if it is available,
+    otherwise with a frame difference detector) and cached. A cut is the
+    1-based id of the first frame of a scene, like the cursor of `Video`.
+    """
+
+    def __init__(self, video_file, thr=0.15):
+        self.video_file = video_file
+        self.splitter = VideoSplitter(thr)
+        self.cuts = []
+        self.ready = False
+
+    def __len__(self):
+        return len(self.cuts)
+
+    def set_sections(self, sections):
+        self.cuts = sorted(int(section[0]) + 1 for section in sections[1:])
+        self.ready = True
+
+    def load_or_build(self):
+        try:
+            self.set_sections(self.splitter.split(self.video_file))
+        except (OSError, ValueError, IndexError) as err:
+            print('failed to split {}: {}'.format(self.video_file, err))
+
+    def load_or_build_async(self):
+        t = threading.Thread(target=self.load_or_build)
+        t.daemon = True
+        t.start()
+
+    def next_cut(self, frame_id):
+        """the first cut after frame_id, None if there is none"""
+        idx = bisect_right(self.cuts, frame_id)
+        if idx == len(self.cuts):
+            return None
+        return self.cuts[idx]
+
+    def prev_cut(self, frame_id):
+        """the last cut before frame_id, None if there is none"""
+        idx = bisect_left(self.cuts, frame_id)
+        if idx == 0:
+            return None
+        return self.cuts[idx - 1]
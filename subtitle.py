@@ -1,43 +1,237 @@
+import heapq
+import math
+import os
+import re
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+import cv2
+
+_TIME_RE = re.compile(r'(?:(\d+):)?(\d+):(\d+)[.,](\d+)')
+_WORD_RE = re.compile(r"\w+(?:'\w+)*")
+_TAG_RE = re.compile(r'<[^>]*>')
+
+
+def find_subtitle(video_file):
+    """the subtitle file next to a video (<name>.srt or <name>.vtt)"""
+    if video_file is None:
+        return None
+    base = os.path.splitext(video_file)[0]
+    for ext in ('.srt', '.vtt'):
+        if os.path.isfile(base + ext):
+            return base + ext
+    return None
+
+
+def tokenize(text):
+    """lowercase words of a text without markup tags"""
+    return _WORD_RE.findall(_TAG_RE.sub(' ', text).lower())
+
+
+def cvt_time(time_text):
+    """seconds of a SRT (00:01:02,500) or VTT (00:01:02.500, 01:02.500)
+    timestamp
+    """
+    match = _TIME_RE.search(time_text)
+    if match is None:
+        raise ValueError('invalid timestamp: {}'.format(time_text))
+    hh, mm, ss, ms = match.groups()
+    return (int(hh or 0) * 3600 + int(mm) * 60 + int(ss) +
+            int(ms) / 10.0 ** len(ms))
+
+
 class Subtitle(object):
+    """subtitle cues of a SRT or VTT file
 
-    def __init__(self, filename):
+    The timestamps are parsed once into lists sorted by start time. The
+    cue shown at a time is looked up with a binary search in the points
+    where it changes, which are swept once when the cues are set, so long
+    cues overlapping many others do not slow it down. `max_ends[i]` is the
+    latest end of the first i + 1 cues, which bounds range queries.
+    """
+
+    def __init__(self, filename=None):
         self.filename = filename
-        self.subs = {}
-        self.load(filename)
+        self.starts = []
+        self.ends = []
+        self.texts = []
+        self.max_ends = []
+        # the cue shown from _points[i] on is _cues[i]
+        self._points = []
+        self._cues = []
+        if filename is not None:
+            self.load(filename)
+
+    def __len__(self):
+        return len(self.starts)
 
-    def cvt_time(self, time_text):
-        [hh, mm, tmp] = time_text.split(':')
-        [ss, ms] = tmp.split('.')
-        [hh, mm, ss, ms] = list(map(float, [hh, mm, ss, ms]))
-        return hh * 3600 + mm * 60 + ss + ms / 1000
+    def set_cues(self, cues):
+        """set a list of (start, end, text)"""
+        cues = sorted(cues, key=lambda cue: (cue[0], cue[1]))
+        self.starts = [cue[0] for cue in cues]
+        self.ends = [cue[1] for cue in cues]
+        self.texts = [cue[2] for cue in cues]
+        self.max_ends = []
+        max_end = float('-inf')
+        for end in self.ends:
+            max_end = max(max_end, end)
+            self.max_ends.append(max_end)
+        self._sweep()
+
+    def _sweep(self):
+        """find the points where the shown cue changes
+
+        A cue is shown from its start to its end inclusive, a start at t is
+        keyed (t, 0) and an end at t (t, 1), so that querying with (t, 0)
+        counts the starts <= t and the ends < t.
+        """
+        events = sorted([(start, 0, idx)
+                         for idx, start in enumerate(self.starts)] +
+                        [(end, 1, idx) for idx, end in enumerate(self.ends)])
+        self._points = []
+        self._cues = []
+        # the latest started cue is shown, ended ones are popped lazily
+        active = []
+        ended = set()
+        for time, kind, idx in events:
+            if kind == 0:
+                heapq.heappush(active, -idx)
+            else:
+                ended.add(idx)
+            while active and -active[0] in ended:
+                heapq.heappop(active)
+            cue = -active[0] if active else None
+            point = (time, kind)
+            if self._points and self._points[-1] == point:
+                self._cues[-1] = cue
+            elif not self._cues or self._cues[-1] != cue:
+                self._points.append(point)
+                self._cues.append(cue)
 
     def load(self, filename):
-        with open(filename, 'r') as fin:
-            slices = fin.read().split('\n\n\n')
-        for slice in slices:
-            data = slice.split('\n')
-            idx = data[0]
-            time_slot = data[1].split(' --> ')
-            start = time_slot[0]
-            end = time_slot[1]
-            text = '\n'.join(data[2:])
-            self.subs[idx] = {'from': start, 'to': end, 'text': text}
+        """load the cues of a file, files which are not UTF-8 are read as
+        latin-1 and cues with invalid timestamps are skipped
+        """
+        with open(filename, 'rb') as fin:
+            data = fin.read()
+        try:
+            content = data.decode('utf-8-sig')
+        except UnicodeDecodeError:
+            content = data.decode('latin-1')
+        content = content.replace('\r\n', '\n').replace('\r', '\n')
+        cues = []
+        for block in re.split(r'\n\s*\n', content):
+            lines = [line for line in block.split('\n') if line.strip()]
+            # the timing line follows an optional cue id, blocks without
+            # one (WEBVTT header, NOTE, STYLE) are skipped
+            for i, line in enumerate(lines[:2]):
+                if '-->' in line:
+                    start, end = line.split('-->', 1)
+                    try:
+                        cues.append((cvt_time(start), cvt_time(end),
+                                     '\n'.join(lines[i + 1:])))
+                    except ValueError:
+                        pass
+                    break
+        self.set_cues(cues)
+
+    def get_cue(self, time):
+        """index of the latest cue starting before time and still shown,
+        None if no cue is shown
+        """
+        idx = bisect_right(self._points, (time, 0)) - 1
+        return self._cues[idx] if idx >= 0 else None
 
     def get_subtitle(self, time):
-        for idx in range(1, len(self.subs) + 1):
-            idx = str(idx)
-            if time > self.cvt_time(self.subs[idx]['to']):
-                continue
-            elif time >= self.cvt_time(self.subs[idx]['from']):
-                return self.subs[idx]['text']
-            else:
-                return None
-
-    # def draw_subtitle(self, ori_img, time):
-    #     text = self.get_subtitle(time)
-    #     if text is None:
-    #         return ori_img
-    #     else:
-    #         img = ori_img.copy()
-    #         font = cv2.FONT_HERSHEY_SIMPLEX
-    #         cv2.putText(img, text, (10, 500), font, 4, (255, 255, 255), 2, cv2.LINE_AA)
+        idx = self.get_cue(time)
+        return self.texts[idx] if idx is not None else None
+
+    def get_range(self, start_time, end_time):
+        """indexes of the cues overlapping [start_time, end_time]"""
+        lo = bisect_left(self.max_ends, start_time)
+        hi = bisect_right(self.starts, end_time)
+        return [idx for idx in range(lo, hi) if self.ends[idx] >= start_time]
+
+    def slice(self, start_time, end_time):
+        """a Subtitle with the cues overlapping [start_time, end_time]"""
+        subtitle = Subtitle()
+        subtitle.filename = self.filename
+        subtitle.set_cues([(self.starts[idx], self.ends[idx], self.texts[idx])
+                           for idx in self.get_range(start_time, end_time)])
+        return subtitle
+
+
+class WordIndex(object):
+    """inverted index from the words of subtitle cues to frame slots
+
+    Every word maps to the sorted indexes of the cues containing it. A
+    phrase is looked up by scanning the cues of its rarest word for the
+    whole phrase. Slots are 1-based [start, end] frames at the given fps.
+    """
+
+    def __init__(self, subtitle, fps):
+        self.subtitle = subtitle
+        self.fps = fps
+        self.cue_words = []
+        self.index = defaultdict(list)
+        for idx, text in enumerate(subtitle.texts):
+            words = tokenize(text)
+            self.cue_words.append(' '.join(words))
+            for word in set(words):
+                self.index[word].append(idx)
+
+    def __len__(self):
+        return len(self.index)
+
+    def slot(self, idx):
+        start = int(self.subtitle.starts[idx] * self.fps) + 1
+        end = max(int(math.ceil(self.subtitle.ends[idx] * self.fps)), start)
+        return start, end
+
+    def lookup_cues(self, phrase, max_num=0):
+        """sorted indexes of the (first max_num if > 0) cues containing a
+        phrase
+        """
+        words = tokenize(phrase)
+        if not words:
+            return []
+        cues = min((self.index.get(word, []) for word in set(words)),
+                   key=len)
+        if len(words) > 1:
+            # the words have to be adjacent and in order
+            pattern = ' {} '.format(' '.join(words))
+            matched = []
+            for idx in cues:
+                if pattern in ' {} '.format(self.cue_words[idx]):
+                    matched.append(idx)
+                    if len(matched) == max_num:
+                        break
+            return matched
+        return cues[:max_num] if max_num > 0 else list(cues)
+
+    def lookup(self, phrase, max_num=0):
+        """[start, end] frame slots of the cues containing a phrase"""
+        return [self.slot(idx) for idx in self.lookup_cues(phrase, max_num)]
+
+
+def draw_subtitle(img, text, line_thickness=2, font_scale=1.2):
+    """draw white text lines centered at the bottom of an image, markup
+    tags are not drawn
+    """
+    text = _TAG_RE.sub('', text) if text else ''
+    lines = [line for line in text.split('\n') if line.strip()]
+    if not lines:
+        return img
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    line_h = int(cv2.getTextSize('Ag', font, font_scale,
+                                 line_thickness)[0][1] * 1.8)
+    y = img.shape[0] - line_h * (len(lines) - 1) - line_h // 2
+    for line in lines:
+        (w, _), _ = cv2.getTextSize(line, font, font_scale, line_thickness)
+        x = max((img.shape[1] - w) // 2, 0)
+        cv2.putText(img, line, (x, y), font, font_scale, (0, 0, 0),
+                    line_thickness + 2, cv2.LINE_AA)
+        cv2.putText(img, line, (x, y), font, font_scale, (255, 255, 255),
+                    line_thickness, cv2.LINE_AA)
+        y += line_h
+    return img
@@ -0,0 +1,60 @@
+import time
+
+import cv2
+import numpy as np
+
+from annotation import Annotation
+from bbox import BoundingBox, SRC_KEYFRAME, SRC_TRACKED
+from tracker import TrackWorker
+
+
+def write_clip(filename, frame_num=60, width=320, height=240):
+    """a textured square moving right over a textured background"""
+    rng = np.random.RandomState(0)
+    background = cv2.GaussianBlur(
+        rng.randint(0, 256, (height, width, 3)).astype(np.uint8), (5, 5), 0)
+    obj = rng.randint(0, 256, (40, 40, 3)).astype(np.uint8)
+    vwriter = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'MJPG'), 25,
+                              (width, height))
+    for i in range(frame_num):
+        img = background.copy()
+        img[100: 140, 20 + i * 2: 60 + i * 2] = obj
+        vwriter.write(img)
+    vwriter.release()
+
+
+def wait_for(worker, timeout=30):
+    deadline = time.time() + timeout
+    while worker.running and time.time() < deadline:
+        time.sleep(0.01)
+    worker.stop()
+
+
+def test_redraw_keeps_later_keyframes(tmp_path):
+    video_file = str(tmp_path / 'clip.avi')
+    write_clip(video_file)
+    annotation = Annotation()
+    tube_id = annotation.next_tube_id
+    annotation.add_tube('obj', 1)
+    for frame_id in range(1, 51):
+        src = SRC_KEYFRAME if frame_id in (1, 20, 40, 50) else SRC_TRACKED
+        annotation.set_bbox(tube_id, frame_id, BoundingBox(
+            'obj', src, 18 + frame_id * 2, 100, 40, 40))
+    before = {frame_id: annotation.get_bbox(tube_id, frame_id)
+              for frame_id in range(20, 51)}
+    # re-draw a box in the middle of the tube
+    bbox = BoundingBox('obj', SRC_KEYFRAME, 35, 98, 44, 44)
+    annotation.set_bbox(tube_id, 10, bbox)
+    worker = TrackWorker(video_file, annotation, tube_id, look_ahead=100,
+                         sim_thr=0)
+    worker.start(10, bbox)
+    worker.set_cursor(60)
+    wait_for(worker)
+    assert worker.last_frame == 19
+    assert annotation.tube_end(tube_id) == 50
+    for frame_id, old_bbox in before.items():
+        new_bbox = annotation.get_bbox(tube_id, frame_id)
+        assert list(new_bbox) == list(old_bbox)
+        assert new_bbox.src == old_bbox.src
+    for frame_id in range(11, 20):
+        assert annotation.get_bbox(tube_id, frame_id).src == SRC_TRACKED
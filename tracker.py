@@ -1,34 +1,212 @@
+import threading
+from collections import namedtuple
+
+import cv2
 import dlib
 
-from bbox import BoundingBox
+from bbox import BoundingBox, SRC_TRACKED
+from ckutils.video import VideoReader
+from drift import DriftDetector
+
+# a decoded frame outside of the Qt video engine
+TrackFrame = namedtuple('TrackFrame', ['id', 'raw_img'])
+
+
+def pyramid_level(width, height, min_size=64, max_level=4):
+    """the coarsest pyramid level at which the shorter side of a box is
+    still at least min_size pixels
+    """
+    level = 0
+    while (level < max_level and
+           min(width, height) >> (level + 1) >= min_size):
+        level += 1
+    return level
 
 
 class Tracker(dlib.correlation_tracker):
+    """correlation tracker on full resolution frames, or on a downscaled
+    (and optionally grayscale) pyramid level chosen from the box size when
+    downscale is True. Boxes are always in full resolution coordinates.
+    """
 
-    def __init__(self):
+    def __init__(self, downscale=False, grayscale=False, min_size=64):
         self.label = None
         self.init_region = None
         self.bbox = None
         self.track_num = 0
+        self.downscale = downscale
+        self.grayscale = grayscale
+        self.min_size = min_size
+        self.scale = 1.0
         super(Tracker, self).__init__()
 
+    def _prepare(self, img):
+        if self.scale != 1.0:
+            img = cv2.resize(img, None, fx=self.scale, fy=self.scale,
+                             interpolation=cv2.INTER_AREA)
+        if self.grayscale and img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        return img
+
     def start_track(self, frame, bbox):
         self.bbox = bbox
-        self.init_region = frame.raw_img[bbox.left: bbox.right,
-                                         bbox.top: bbox.bottom]
+        self.init_region = frame.raw_img[bbox.top: bbox.bottom,
+                                         bbox.left: bbox.right]
         self.label = bbox.label
+        if self.downscale:
+            level = pyramid_level(bbox.right - bbox.left,
+                                  bbox.bottom - bbox.top, self.min_size)
+            self.scale = 1.0 / (1 << level)
+        s = self.scale
         super(Tracker, self).start_track(
-            frame.raw_img,
-            dlib.rectangle(bbox.left, bbox.top, bbox.right, bbox.bottom)
+            self._prepare(frame.raw_img),
+            dlib.rectangle(int(round(bbox.left * s)),
+                           int(round(bbox.top * s)),
+                           int(round(bbox.right * s)),
+                           int(round(bbox.bottom * s)))
         )
 
     def update(self, frame):
         self.track_num += 1
-        score = super(Tracker, self).update(frame.raw_img)
+        score = super(Tracker, self).update(self._prepare(frame.raw_img))
         rect = super(Tracker, self).get_position()
-        l = int(rect.left())
-        r = int(rect.right())
-        t = int(rect.top())
-        b = int(rect.bottom())
-        self.bbox = BoundingBox(self.label, 0, l, t, r - l, b - t)
+        l = int(round(rect.left() / self.scale))
+        r = int(round(rect.right() / self.scale))
+        t = int(round(rect.top() / self.scale))
+        b = int(round(rect.bottom() / self.scale))
+        self.bbox = BoundingBox(self.label, SRC_TRACKED, l, t, r - l, b - t)
         return (self.bbox, score)
+
+
+class TrackWorker(object):
+    """propagate a tube ahead of the cursor in a background thread
+
+    The worker decodes the video with its own reader, tracks the tube from
+    the frame where it was started and writes the boxes into the
+    annotation, staying at most `look_ahead` frames ahead of the cursor.
+    It stops before `stop_frame` (e.g. the next scene cut), before the next
+    keyframe of the tube, so that re-drawing a box inside a tube does not
+    overwrite the keyframes after it, and when the colour histogram of the
+    tracked region is no longer similar enough (`sim_thr`) to the initial
+    region. Boxes tracked with a similarity below `review_thr` are flagged
+    for review.
+    """
+
+    def __init__(self, video_file, annotation, tube_id, look_ahead=30,
+                 sim_thr=0.9, hist_bins=16, downscale=False,
+                 grayscale=False, stop_frame=None, review_thr=None):
+        self.video_file = video_file
+        self.annotation = annotation
+        self.tube_id = tube_id
+        self.look_ahead = look_ahead
+        self.sim_thr = sim_thr
+        self.review_thr = review_thr if review_thr is not None else sim_thr
+        self.drift = DriftDetector(hist_bins)
+        self.downscale = downscale
+        self.grayscale = grayscale
+        self.stop_frame = stop_frame
+        # last frame with a tracked box and the furthest frame displayed
+        self.last_frame = 0
+        self.reviewed = 0
+        # end of the tube when tracking started, boxes up to it were not
+        # appended by this worker
+        self.tube_end = 0
+        # the first keyframe of the tube after the start, if any
+        self.keyframe = None
+        self.cursor = 0
+        self.lost = False
+        self._stop = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    @property
+    def appended_from(self):
+        """the first frame of the boxes appended to the tube by this worker
+        which have not been displayed yet
+        """
+        return max(self.reviewed, self.tube_end) + 1
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, frame_id, bbox):
+        self.stop()
+        self.last_frame = self.reviewed = self.cursor = frame_id
+        self.tube_end = self.annotation.tube_end(self.tube_id)
+        self.keyframe = self.annotation.next_keyframe(self.tube_id, frame_id)
+        self.lost = False
+        self._stop = False
+        self._thread = threading.Thread(target=self._run,
+                                        args=(frame_id, bbox))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """stop tracking, no box is written after it returns"""
+        if self._thread is None:
+            return
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._thread = None
+
+    def set_cursor(self, frame_id):
+        with self._cond:
+            self.cursor = frame_id
+            self.reviewed = max(self.reviewed, frame_id)
+            self._cond.notify_all()
+
+    def is_tracked(self, frame_id):
+        return frame_id <= self.last_frame
+
+    def is_low_confidence(self, frame_id):
+        sim = self.drift.score(self.tube_id, frame_id)
+        return sim is not None and sim < self.review_thr
+
+    def low_confidence(self):
+        """sorted frames flagged for review"""
+        return self.drift.low_confidence(self.tube_id, self.review_thr)
+
+    def _wait_for_cursor(self):
+        with self._cond:
+            while (not self._stop and
+                   self.last_frame >= self.cursor + self.look_ahead):
+                self._cond.wait()
+            return not self._stop
+
+    def _run(self, frame_id, bbox):
+        vreader = VideoReader(self.video_file)
+        try:
+            ret, img = vreader.get_frame(frame_id)
+            if not ret:
+                return
+            tracker = Tracker(self.downscale, self.grayscale)
+            tracker.start_track(TrackFrame(frame_id, img), bbox)
+            self.drift.set_reference(self.tube_id, img, bbox)
+            frame_rect = BoundingBox(None, 0, 0, 0, vreader.width,
+                                     vreader.height)
+            end = vreader.frame_cnt
+            if self.stop_frame is not None:
+                end = min(end, self.stop_frame - 1)
+            if self.keyframe is not None:
+                end = min(end, self.keyframe - 1)
+            while self._wait_for_cursor() and frame_id < end:
+                ret, img = vreader.read()
+                if not ret:
+                    break
+                frame_id += 1
+                bbox, _ = tracker.update(TrackFrame(frame_id, img))
+                bbox = bbox.intersected(frame_rect)
+                sims = self.drift.update(frame_id, img, {self.tube_id: bbox})
+                if sims[self.tube_id] < self.sim_thr:
+                    self.lost = True
+                    break
+                with self._cond:
+                    if self._stop:
+                        break
+                    self.annotation.set_bbox(self.tube_id, frame_id, bbox)
+                    self.last_frame = frame_id
+        finally:
+            vreader.release()
@@ -1,13 +1,17 @@
+import queue
 import threading
 import time
 from collections import OrderedDict
 from enum import Enum
 
 import cv2
-from PyQt5.QtCore import QObject, pyqtSignal
+from PyQt5.QtCore import QObject, Qt, pyqtSignal
 from PyQt5.QtGui import QImage, QPixmap
 
+import exporter
 from ckutils.video import VideoReader
+from keyframe_index import KeyframeIndex
+from scene_index import SceneIndex
 
 
 class VideoStatus(Enum):
@@ -19,126 +23,510 @@ class VideoStatus(Enum):
     frame_backward = 4
 
 
-class VideoFrame(QPixmap):
+def fit_size(width, height, max_width, max_height):
+    """the size of (width, height) scaled to fit in (max_width, max_height)
+    while keeping the aspect ratio, same as QSize.scaled(Qt.KeepAspectRatio)
+    """
+    scaled_width = max_height * width // height
+    if scaled_width <= max_width:
+        return (scaled_width, max_height)
+    return (max_width, max_width * height // width)
 
-    def __init__(self, img, id):
-        qimage = self.mat2qimage(img)
-        super(VideoFrame, self).__init__(QPixmap.fromImage(qimage))
+
+class VideoFrame(object):
+    """a decoded frame, QImages share the buffers of the numpy images when
+    Qt supports BGR888 (>= 5.14) and pixmaps are only built when shown
+
+    A frame served from the display cache only has `display_img`, the full
+    resolution image is decoded by `loader` when `raw_img` is accessed.
+    """
+
+    def __init__(self, img, id, display_img=None, loader=None, size=None):
         self.id = id
-        self.raw_img = img
+        self.display_img = display_img
+        self._raw_img = img
+        self._loader = loader
+        self._qimage = None
+        self._pixmap = None
+        # numpy buffers referenced by QImages must be kept alive
+        self._buffers = []
+        if img is not None:
+            self.height, self.width = img.shape[:2]
+        else:
+            self.width, self.height = size
+        # bytes allocated for this frame, including the decoded images
+        self.allocated_bytes = 0
+        for _img in (img, display_img):
+            if _img is not None:
+                self.allocated_bytes += _img.nbytes
+
+    @property
+    def raw_img(self):
+        if self._raw_img is None and self._loader is not None:
+            self._raw_img = self._loader(self.id)
+            if self._raw_img is not None:
+                self.allocated_bytes += self._raw_img.nbytes
+        return self._raw_img
+
+    @property
+    def qimage(self):
+        if self._qimage is None:
+            self._qimage = self.mat2qimage(self.raw_img)
+        return self._qimage
 
     def mat2qimage(self, img):
+        height, width, depth = img.shape
+        if hasattr(QImage, 'Format_BGR888'):
+            self._buffers.append(img)
+            return QImage(img.data, width, height, img.strides[0],
+                          QImage.Format_BGR888)
         rgb_img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        height, width, depth = rgb_img.shape
-        bytes_per_line = depth * width
-        qimage = QImage(rgb_img.data, width, height, bytes_per_line,
-                        QImage.Format_RGB888)
-        return qimage
+        self._buffers.append(rgb_img)
+        self.allocated_bytes += rgb_img.nbytes
+        return QImage(rgb_img.data, width, height, rgb_img.strides[0],
+                      QImage.Format_RGB888)
+
+    @property
+    def pixmap(self):
+        if self._pixmap is None:
+            self._pixmap = QPixmap.fromImage(self.qimage)
+            self.allocated_bytes += self._pixmap_bytes(self._pixmap)
+        return self._pixmap
+
+    def scaled_pixmap(self, width, height):
+        """use the downscaled image if it has the requested size, otherwise
+        scale the image before converting it, so that no full resolution
+        pixmap is created
+        """
+        if (self.display_img is not None and
+                self.display_img.shape[1::-1] ==
+                fit_size(self.width, self.height, width, height)):
+            pixmap = QPixmap.fromImage(self.mat2qimage(self.display_img))
+            self.allocated_bytes += self._pixmap_bytes(pixmap)
+            return pixmap
+        if self._pixmap is not None:
+            return self._pixmap.scaled(width, height, Qt.KeepAspectRatio)
+        qimage = self.qimage.scaled(width, height, Qt.KeepAspectRatio)
+        pixmap = QPixmap.fromImage(qimage)
+        self.allocated_bytes += (qimage.bytesPerLine() * qimage.height() +
+                                 self._pixmap_bytes(pixmap))
+        return pixmap
+
+    def _pixmap_bytes(self, pixmap):
+        return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+
+class DisplayCache(object):
+    """LRU cache of frames downscaled to the display size, bounded in bytes"""
+
+    def __init__(self, capacity_bytes):
+        self.capacity_bytes = capacity_bytes
+        self.size = None
+        self.nbytes = 0
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def __contains__(self, frame_id):
+        return frame_id in self._frames
+
+    def reset(self, size=None):
+        with self._lock:
+            self.size = size
+            self.nbytes = 0
+            self._frames.clear()
+
+    def get(self, frame_id):
+        with self._lock:
+            if frame_id not in self._frames:
+                return None
+            self._frames.move_to_end(frame_id)
+            return self._frames[frame_id]
+
+    def put(self, frame_id, img):
+        """downscale img to the display size and cache it
+        return the downscaled image or None if no downscaling is needed
+        """
+        size = self.size
+        if (size is None or size[0] >= img.shape[1] or
+                size[1] >= img.shape[0]):
+            return None
+        display_img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+        with self._lock:
+            if self.size != size:
+                return display_img
+            if frame_id in self._frames:
+                self.nbytes -= self._frames.pop(frame_id).nbytes
+            self._frames[frame_id] = display_img
+            self.nbytes += display_img.nbytes
+            while self.nbytes > self.capacity_bytes and len(self._frames) > 1:
+                _, evicted = self._frames.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+        return display_img
+
+
+class FramePrefetcher(object):
+    """decode frames ahead of the playback cursor in a background thread
+    each start/stop begins a new generation and drops the queued frames
+    """
+
+    def __init__(self, video, max_size=16):
+        self.video = video
+        self.max_size = max_size
+        self.generation = 0
+        self.underrun_cnt = 0
+        self._queue = queue.Queue(max_size)
+        self._stop_event = threading.Event()
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def start(self, frame_id, step=1):
+        self.stop()
+        self._queue = queue.Queue(self.max_size)
+        self._stop_event = threading.Event()
+        t = threading.Thread(target=self._decode_loop,
+                             args=(frame_id, step, self._queue,
+                                   self._stop_event))
+        t.daemon = True
+        t.start()
+        return self.generation
+
+    def stop(self):
+        self._stop_event.set()
+        self.generation += 1
+
+    def get(self, generation=None):
+        """get the next decoded frame
+
+        Return None if there are no more frames or the prefetcher has been
+        restarted or stopped since `generation`.
+        """
+        frame_queue = self._queue
+        if frame_queue.empty():
+            self.underrun_cnt += 1
+        while generation is None or generation == self.generation:
+            try:
+                return frame_queue.get(timeout=0.05)
+            except queue.Empty:
+                continue
+        return None
+
+    def _put(self, frame_queue, stop_event, frame):
+        while not stop_event.is_set():
+            try:
+                frame_queue.put(frame, timeout=0.05)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _decode_loop(self, frame_id, step, frame_queue, stop_event):
+        while (not stop_event.is_set() and
+               1 <= frame_id <= self.video.frame_cnt):
+            if step < 0:
+                self.video.decode_chunk(frame_id)
+            frame = self.video.read_frame(frame_id)
+            if frame is None:
+                break
+            if not self._put(frame_queue, stop_event, frame):
+                return
+            frame_id += step
+        self._put(frame_queue, stop_event, None)
+
+    def stats(self):
+        return dict(depth=self.depth, capacity=self.max_size,
+                    underruns=self.underrun_cnt,
+                    decode_cost=self.video.decode_cost())
 
 
 class Video(QObject):
 
     frame_updated = pyqtSignal(VideoFrame)
     export_progress_updated = pyqtSignal(int)
+    export_finished = pyqtSignal(dict)
 
-    def __init__(self, filename=None, cache_capacity=500, max_fps=0):
+    def __init__(self, filename=None, cache_capacity=500, max_fps=0,
+                 prefetch_size=16, chunk_size=64, cache_bytes=2 << 30,
+                 display_cache_bytes=512 << 20):
         super(Video, self).__init__()
         self.vreader = None
+        self.keyframe_index = None
+        self.scene_index = None
+        # the reader cache holds at most cache_capacity full resolution
+        # frames and no more than cache_bytes
         self.cache_capacity = cache_capacity
+        self.cache_bytes = cache_bytes
+        # backward playback decodes chunks of this size into the cache
+        self.max_chunk_size = chunk_size
+        self.chunk_size = min(chunk_size, cache_capacity)
+        self.display_cache = DisplayCache(display_cache_bytes)
+        self.display_size = None
         self.status = VideoStatus.not_loaded
         self.max_fps = max_fps
         self.filename = filename
+        self._cursor = 0
+        self._chunk = (0, -1)
+        # frames read from the reader except cache hits, to tell whether
+        # the last chunk may have been evicted from its cache
+        self.reader_capacity = 0
+        self._read_num = 0
+        self._chunk_read_num = 0
+        self._decode_time = 0.0
+        self._decode_num = 0
+        self._lock = threading.Lock()
+        # held by the playback thread from checking its generation until
+        # the frame is emitted, and while playback is stopped
+        self._play_lock = threading.RLock()
+        self.prefetcher = FramePrefetcher(self, prefetch_size)
+        self.export_cancel_event = threading.Event()
         if filename is not None:
             self.load(filename)
 
     @property
     def cursor(self):
-        return self.vreader.position
+        return self._cursor
 
     def load(self, filename):
+        self.stop_playback()
         self.filename = filename
-        self.vreader = VideoReader(filename, self.cache_capacity)
+        cap = cv2.VideoCapture(filename)
+        frame_bytes = 3 * max(int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)) *
+                              int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), 1)
+        cap.release()
+        capacity = max(min(self.cache_capacity,
+                           self.cache_bytes // frame_bytes), 1)
+        self.chunk_size = min(self.max_chunk_size, capacity)
+        with self._lock:
+            self.vreader = VideoReader(filename, capacity)
+        self.reader_capacity = capacity
+        self._cursor = 0
+        self._chunk = (0, -1)
+        self.keyframe_index = KeyframeIndex(filename)
+        self.keyframe_index.load_or_build_async()
+        self.scene_index = SceneIndex(filename)
+        self.scene_index.load_or_build_async()
         self.status = VideoStatus.pause
         self.width = self.vreader.width
         self.height = self.vreader.height
         self.fps = self.vreader.fps
         self.frame_cnt = self.vreader.frame_cnt
+        self.display_cache.reset()
+        if self.display_size is not None:
+            self.set_display_size(*self.display_size)
+
+    def set_display_size(self, width, height):
+        """frames are cached at the size they are displayed with, changing
+        the size invalidates the display cache
+        """
+        self.display_size = (width, height)
+        if self.vreader is None or width <= 0 or height <= 0:
+            return
+        size = fit_size(self.width, self.height, width, height)
+        if size != self.display_cache.size:
+            self.display_cache.reset(size)
+
+    def read_frame(self, frame_id):
+        """get a frame without moving the cursor (thread safe)
+        the full resolution image is only decoded if the frame is not in the
+        display cache
+        """
+        display_img = self.display_cache.get(frame_id)
+        if display_img is not None:
+            return VideoFrame(None, frame_id, display_img, self.read_raw,
+                              (self.width, self.height))
+        img = self.read_raw(frame_id)
+        if img is None:
+            return None
+        display_img = self.display_cache.put(frame_id, img)
+        return VideoFrame(img, frame_id, display_img)
+
+    def read_raw(self, frame_id):
+        """decode a full resolution image (thread safe)"""
+        with self._lock:
+            start = time.time()
+            if self.vreader.position == frame_id - 1:
+                ret, img = self._read()
+            elif (self.vreader.position == frame_id or
+                  self._in_chunk(frame_id)):
+                # a hit in the reader cache, which evicts nothing
+                ret, img = self.vreader.get_frame(frame_id)
+            else:
+                ret, img = self._seek(frame_id)
+            self._add_decode_cost(1, time.time() - start)
+        if ret:
+            return img
+        else:
+            return None
+
+    def _seek(self, frame_id):
+        """seek to the nearest keyframe and decode forward to frame_id,
+        fall back to the seeking of the reader if there is no index yet
+        """
+        keyframe = self.keyframe_index.nearest_keyframe(frame_id)
+        if keyframe is None:
+            return self._get_frame(frame_id)
+        if keyframe <= self.vreader.position < frame_id:
+            ret = True
+        else:
+            ret, img = self._get_frame(keyframe)
+        while ret and self.vreader.position < frame_id:
+            ret, img = self._read()
+        return ret, img
+
+    def _read(self):
+        self._read_num += 1
+        return self.vreader.read()
+
+    def _get_frame(self, frame_id):
+        self._read_num += 1
+        return self.vreader.get_frame(frame_id)
+
+    def _in_chunk(self, frame_id):
+        """whether frame_id is in the last decoded chunk and still in the
+        reader cache, i.e. no more frames than the cache has room for
+        besides the chunk have been decoded since
+        """
+        chunk_start, chunk_end = self._chunk
+        return (chunk_start <= frame_id <= chunk_end and
+                self._read_num - self._chunk_read_num <=
+                self.reader_capacity - (chunk_end - chunk_start + 1))
+
+    def decode_chunk(self, frame_id):
+        """decode the chunk ending at frame_id forward into the reader cache
+        so that reading backwards from frame_id only hits the cache
+        """
+        if self._in_chunk(frame_id) or frame_id in self.display_cache:
+            return
+        chunk_start = max(frame_id - self.chunk_size + 1, 1)
+        keyframe = self.keyframe_index.nearest_keyframe(frame_id)
+        if keyframe is not None and keyframe > chunk_start:
+            # stop at the GOP boundary, the previous GOP is the next chunk
+            chunk_start = keyframe
+        with self._lock:
+            start = time.time()
+            ret, _ = self._seek(chunk_start)
+            chunk_end = chunk_start
+            while ret and chunk_end < frame_id:
+                ret, _ = self._read()
+                if ret:
+                    chunk_end += 1
+            self._add_decode_cost(chunk_end - chunk_start + 1,
+                                  time.time() - start)
+            self._chunk = (chunk_start, chunk_end)
+            self._chunk_read_num = self._read_num
+
+    def _add_decode_cost(self, frame_num, seconds):
+        self._decode_num += frame_num
+        self._decode_time += seconds
+
+    def decode_cost(self, reset=False):
+        """average decoding time per frame in milliseconds"""
+        cost = (1000 * self._decode_time / self._decode_num
+                if self._decode_num > 0 else 0.0)
+        if reset:
+            self._decode_time = 0.0
+            self._decode_num = 0
+        return cost
 
     def get_frame(self, frame_id=0):
         """get a frame by frame_id
         frame_id = 0 means the next frame
         """
         if frame_id == 0:
-            ret, img = self.vreader.read()
-        else:
-            ret, img = self.vreader.get_frame(frame_id)
-        if ret:
-            return VideoFrame(img, self.cursor)
-        else:
-            return None
+            frame_id = self._cursor + 1
+        frame = self.read_frame(frame_id)
+        if frame is not None:
+            self._cursor = frame.id
+        return frame
 
     def current_frame(self):
-        img = self.vreader.current_frame()
-        return VideoFrame(img, self.cursor)
+        return self.read_frame(self._cursor)
 
     def frame_forward(self):
+        self.stop_playback()
         if self.cursor >= self.frame_cnt:
             self.status = VideoStatus.pause
             return
-        if self.status != VideoStatus.play_forward:
-            self.status = VideoStatus.frame_forward
+        self.status = VideoStatus.frame_forward
         return self.get_frame()
 
     def frame_backward(self):
+        self.stop_playback()
         if self.cursor <= 1:
             self.status = VideoStatus.pause
             return
-        if self.status != VideoStatus.play_backward:
-            self.status = VideoStatus.frame_backward
+        self.status = VideoStatus.frame_backward
+        self.decode_chunk(self.cursor - 1)
         return self.get_frame(self.cursor - 1)
 
     def jump_to_frame(self, frame_id):
-        self.status = VideoStatus.pause
+        self.pause()
         if frame_id < 1 or frame_id > self.frame_cnt:
             return
         return self.get_frame(frame_id)
 
-    def play_forward_func(self):
-        self.status = VideoStatus.play_forward
+    def play_func(self, status, step):
+        self.status = status
+        generation = self.prefetcher.start(self._cursor + step, step)
         min_interval = 1 / self.max_fps if self.max_fps > 0 else 0
-        while (self.status == VideoStatus.play_forward and
-               self.cursor < self.frame_cnt):
+        while (self.status == status and
+               self.prefetcher.generation == generation):
             start = time.time()
-            frame = self.frame_forward()
+            frame = self.prefetcher.get(generation)
+            if frame is None or self.prefetcher.generation != generation:
+                break
             ellapsed = time.time() - start
             if self.max_fps > 0 and ellapsed < min_interval:
                 time.sleep(min_interval - ellapsed)
-            self.frame_updated.emit(frame)
+            # playback may have been paused, or the cursor moved, while
+            # sleeping
+            with self._play_lock:
+                if (self.status != status or
+                        self.prefetcher.generation != generation):
+                    break
+                self._cursor = frame.id
+                self.frame_updated.emit(frame)
+        if self.prefetcher.generation == generation:
+            self.prefetcher.stop()
+            if self.status == status:
+                self.status = VideoStatus.pause
+
+    def play_forward_func(self):
+        self.play_func(VideoStatus.play_forward, 1)
 
     def play_backward_func(self):
-        self.status = VideoStatus.play_backward
-        min_interval = 1 / self.max_fps if self.max_fps > 0 else 0
-        while (self.status == VideoStatus.play_backward and self.cursor > 1):
-            start = time.time()
-            frame = self.frame_backward()
-            ellapsed = time.time() - start
-            if self.max_fps > 0 and ellapsed < min_interval:
-                time.sleep(min_interval - ellapsed)
-            self.frame_updated.emit(frame)
+        self.play_func(VideoStatus.play_backward, -1)
 
     def play_forward(self):
+        self.stop_playback()
         t = threading.Thread(target=self.play_forward_func)
         t.daemon = True
         t.start()
 
     def play_backward(self):
+        self.stop_playback()
         t = threading.Thread(target=self.play_backward_func)
         t.daemon = True
         t.start()
 
     def pause(self):
+        self.stop_playback()
         self.status = VideoStatus.pause
 
+    def stop_playback(self):
+        """stop the playback thread, no frame of it is emitted and the
+        cursor is not moved by it after this returns
+        """
+        with self._play_lock:
+            self.prefetcher.stop()
+
+    def prefetch_stats(self):
+        return self.prefetcher.stats()
+
     def is_forward(self):
         if (self.status == VideoStatus.play_forward or
                 self.status == VideoStatus.frame_forward):
@@ -146,28 +534,26 @@ class Video(QObject):
         else:
             return False
 
-    def export(self, out_file, annotation, start=1, end=0):
-        completed = 0
-        end = self.frame_cnt if end == 0 else end
-        export_num = end - start + 1
-        line_thickness = int(min(self.width, self.height) / 200)
-        vreader = VideoReader(self.filename)
-        vwriter = cv2.VideoWriter(out_file, cv2.VideoWriter_fourcc(*'XVID'),
-                                  self.fps, (self.width, self.height))
-        while completed < export_num:
-            ret, img = vreader.get_frame(start + completed)
-            if ret == 0:
-                break
-            bboxes = annotation.get_bboxes(completed + start)
-            for bbox in bboxes:
-                cv2.rectangle(img, bbox.left_top, bbox.right_bottom,
-                              (0, 0, 255), line_thickness)
-                cv2.putText(img, bbox.label, bbox.left_top,
-                            cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 0, 255),
-                            line_thickness)
-            vwriter.write(img)
-            completed += 1
-            progress = int(round(100 * completed / export_num))
-            self.export_progress_updated.emit(progress)
-        vreader.release()
-        vwriter.release()
+    def export(self, out_file, annotation, start=1, end=0, worker_num=1,
+               fourcc='XVID', scale=1.0, progress=None, with_signals=True,
+               subtitle=None):
+        """export the video with bounding boxes, blocking until it is done
+        or cancelled
+
+        Progress and the summary are emitted as signals unless with_signals
+        is False, use exporter.export_video directly where Qt is not
+        available.
+        """
+        if progress is None and with_signals:
+            progress = self.export_progress_updated.emit
+        self.export_cancel_event.clear()
+        summary = exporter.export_video(
+            self.filename, out_file, annotation, start, end, worker_num,
+            fourcc, scale, progress, self.keyframe_index,
+            self.export_cancel_event, subtitle)
+        if with_signals:
+            self.export_finished.emit(summary)
+        return summary
+
+    def cancel_export(self):
+        self.export_cancel_event.set()
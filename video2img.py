@@ -1,53 +1,288 @@
+import argparse
+import json
 import math
+import multiprocessing
 import os
 
 import cv2
 import numpy as np
 from PIL import Image
 
-from video import Annotation
+from annotation import Annotation, SRC_NONE
+from bbox import SRC_KEYFRAME
+
+
+def iter_frames(cap, frames, max_gap=300):
+    """decode sorted 0-based frames in order
+
+    Frames in between are grabbed without being decoded, only gaps longer
+    than max_gap frames are skipped by seeking.
+    """
+    pos = 0
+    for frame_idx in frames:
+        if frame_idx - pos > max_gap:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+            pos = frame_idx
+        while pos < frame_idx:
+            if not cap.grab():
+                return
+            pos += 1
+        ret, img = cap.read()
+        if not ret:
+            return
+        pos += 1
+        yield frame_idx, img
+
+
+def tile_size(frame_width, frame_height, tile_width=0):
+    """thumbnail size keeping the aspect ratio, full size if tile_width is 0
+    """
+    if tile_width <= 0 or tile_width >= frame_width:
+        return frame_width, frame_height
+    return tile_width, max(int(round(frame_height * tile_width /
+                                     frame_width)), 1)
+
+
+def page_filename(out_filename, page_idx, page_num):
+    if page_num == 1:
+        return out_filename
+    base, ext = os.path.splitext(out_filename)
+    return '{}_{:03d}{}'.format(base, page_idx + 1, ext)
+
+
+def save_page(img, out_filename, page_idx, page_num):
+    """write a page, pages of a pdf are appended to the same file"""
+    ext = os.path.splitext(out_filename)[-1]
+    if ext == '.pdf':
+        img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        img_pil = Image.fromarray(img_rgb)
+        img_pil.save(out_filename, 'PDF', resolution=100.0,
+                     append=page_idx > 0)
+    else:
+        cv2.imwrite(page_filename(out_filename, page_idx, page_num), img)
 
 
 def video2img(filename, out_filename, frame_list=None, frame_interval=1,
-              img_per_row=50, max_num=0):
+              img_per_row=50, max_num=0, tile_width=0, rows_per_page=0,
+              max_page_bytes=256 * 2**20):
+    """tile sampled frames of a video into a contact sheet
+
+    Frames are sorted and read in one sequential pass. Each frame is
+    downsampled to tile_width (full size if 0) and only one page of
+    rows_per_page rows is kept in memory. If rows_per_page is 0, a page
+    has as many rows as fit in max_page_bytes. Pages are written as
+    <name>_001.png, ... or as the pages of a single pdf.
+    """
     cap = cv2.VideoCapture(filename)
     if frame_list is None:
         frame_num = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
         frame_list = range(frame_num)
     frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    sample_num = int(len(frame_list) / frame_interval)
+    frames = sorted(set(frame_list))[::frame_interval]
     if max_num > 0:
-        sample_num = min(sample_num, max_num)
-    frames = frame_list[0: len(frame_list): frame_interval][:sample_num]
+        frames = frames[:max_num]
+    sample_num = len(frames)
+    if sample_num == 0:
+        cap.release()
+        return
+    tile_w, tile_h = tile_size(frame_width, frame_height, tile_width)
     rows = int(math.ceil(sample_num / img_per_row))
     cols = img_per_row if rows > 1 else sample_num
-    full_img = np.zeros((rows * frame_height, cols * frame_width, 3),
-                        dtype=np.uint8)
-    for i, frame_idx in enumerate(frames):
+    if rows_per_page <= 0:
+        rows_per_page = max(max_page_bytes // (tile_h * cols * tile_w * 3),
+                            1)
+    page_rows = min(rows_per_page, rows)
+    page_num = int(math.ceil(rows / page_rows))
+    page = None
+    page_idx = -1
+    for i, (frame_idx, img) in enumerate(iter_frames(cap, frames)):
         print('frame #', frame_idx)
-        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
-        ret, img = cap.read()
-        row_idx = int(i / img_per_row)
-        col_idx = i % img_per_row
-        start_x = col_idx * frame_width
-        start_y = row_idx * frame_height
-        full_img[start_y: start_y + frame_height,
-                 start_x: start_x + frame_width, :] = img
-    ext = os.path.splitext(out_filename)[-1]
-    if ext == '.pdf':
-        img_rgb = cv2.cvtColor(full_img, cv2.COLOR_BGR2RGB)
-        img_pil = Image.fromarray(img_rgb)
-        img_pil.save(out_filename, 'PDF', resolution=100.0)
-    else:
-        cv2.imwrite(out_filename, full_img)
+        if i // (page_rows * img_per_row) != page_idx:
+            if page is not None:
+                save_page(page, out_filename, page_idx, page_num)
+            page_idx = i // (page_rows * img_per_row)
+            page_rows_used = min(page_rows, rows - page_idx * page_rows)
+            page = np.zeros((page_rows_used * tile_h, cols * tile_w, 3),
+                            dtype=np.uint8)
+        if img.shape[1] != tile_w or img.shape[0] != tile_h:
+            img = cv2.resize(img, (tile_w, tile_h),
+                             interpolation=cv2.INTER_AREA)
+        row_idx, col_idx = divmod(i % (page_rows * img_per_row), img_per_row)
+        start_x = col_idx * tile_w
+        start_y = row_idx * tile_h
+        page[start_y: start_y + tile_h, start_x: start_x + tile_w, :] = img
+    cap.release()
+    if page is not None:
+        save_page(page, out_filename, page_idx, page_num)
+
+
+def select_tube_frames(annotation, keyframe_interval=1):
+    """frames to show for every tube: the first and last annotated frames
+    and every keyframe_interval-th keyframe (none if 0)
+    return a list of (frame_id, tube_id) sorted by frame
+    """
+    entries = set()
+    for tube_id, tube in annotation.tubes.items():
+        srcs = tube.srcs
+        annotated = np.flatnonzero(srcs != SRC_NONE)
+        if annotated.shape[0] == 0:
+            continue
+        idxes = [annotated[0], annotated[-1]]
+        if keyframe_interval > 0:
+            idxes.extend(np.flatnonzero(
+                srcs == SRC_KEYFRAME)[::keyframe_interval])
+        for idx in idxes:
+            entries.add((tube.start + int(idx), tube_id))
+    return sorted(entries)
+
+
+def fit_tile(img, tile_w, tile_h):
+    """resize an image into a tile keeping its aspect ratio"""
+    tile = np.zeros((tile_h, tile_w, 3), dtype=np.uint8)
+    h, w = img.shape[:2]
+    if h == 0 or w == 0:
+        return tile
+    scale = min(tile_w / w, tile_h / h)
+    new_w = max(int(w * scale), 1)
+    new_h = max(int(h * scale), 1)
+    img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
+    x = (tile_w - new_w) // 2
+    y = (tile_h - new_h) // 2
+    tile[y: y + new_h, x: x + new_w] = img
+    return tile
+
+
+def _atlas_worker(args):
+    """decode a frame range and render its tiles
+    items are (tile_idx, frame_id, rect, label) sorted by frame
+    """
+    filename, items, mode, tile_w, tile_h, margin = args
+    cap = cv2.VideoCapture(filename)
+    frame_ids = sorted(set(item[1] for item in items))
+    tiles = []
+    item_idx = 0
+    for frame_idx, img in iter_frames(cap, [i - 1 for i in frame_ids]):
+        while item_idx < len(items) and items[item_idx][1] == frame_idx + 1:
+            tile_idx, _, (x, y, w, h), label = items[item_idx]
+            if mode == 'crop':
+                dx = int(w * margin)
+                dy = int(h * margin)
+                region = img[max(y - dy, 0): y + h + dy,
+                             max(x - dx, 0): x + w + dx]
+            else:
+                region = img.copy()
+                thickness = max(int(min(img.shape[:2]) / 200), 1)
+                cv2.rectangle(region, (x, y), (x + w, y + h), (0, 0, 255),
+                              thickness)
+                cv2.putText(region, label, (x, y), cv2.FONT_HERSHEY_SIMPLEX,
+                            1.2, (0, 0, 255), thickness)
+            tiles.append((tile_idx, fit_tile(region, tile_w, tile_h)))
+            item_idx += 1
+    cap.release()
+    return tiles
+
+
+def annotation_atlas(filename, annotation, out_filename, keyframe_interval=1,
+                     mode='crop', worker_num=None, tile_width=160,
+                     tile_height=120, img_per_row=20, rows_per_page=50,
+                     margin=0.1):
+    """tile the frames selected by select_tube_frames into an atlas
+
+    Boxes are cropped (with a margin) or drawn on the whole frame
+    (mode 'overlay'). The frames are decoded in parallel by processes
+    which read contiguous frame ranges of at most a page, and every page
+    is written once its tiles are rendered. A JSON index <name>.json maps
+    every tile to its file, page number, position, tube and frame.
+    """
+    entries = select_tube_frames(annotation, keyframe_interval)
+    items = []
+    index = []
+    page_size = img_per_row * rows_per_page
+    page_num = int(math.ceil(len(entries) / page_size))
+    is_pdf = os.path.splitext(out_filename)[-1] == '.pdf'
+    for i, (frame_id, tube_id) in enumerate(entries):
+        bbox = annotation.get_bbox(tube_id, frame_id)
+        items.append((i, frame_id, [int(v) for v in bbox], bbox.label))
+        page_idx = i // page_size
+        row_idx, col_idx = divmod(i % page_size, img_per_row)
+        # all pages of a pdf are in the same file
+        page_file = (out_filename if is_pdf else
+                     page_filename(out_filename, page_idx, page_num))
+        index.append(dict(
+            tile=i, file=os.path.basename(page_file), page=page_idx + 1,
+            row=row_idx, col=col_idx, tube_id=tube_id, label=bbox.label,
+            frame=frame_id, bbox=[int(v) for v in bbox]))
+    if worker_num is None:
+        worker_num = multiprocessing.cpu_count()
+    # ranges of at most a page keep the rendered tiles which wait for
+    # their page bounded
+    task_size = max(min(page_size,
+                        int(math.ceil(len(items) / max(worker_num, 1)))), 1)
+    tasks = [(filename, items[i: i + task_size], mode, tile_width,
+              tile_height, margin)
+             for i in range(0, len(items), task_size)]
+
+    def new_page(page_idx):
+        tile_num = min(page_size, len(items) - page_idx * page_size)
+        rows = int(math.ceil(tile_num / img_per_row))
+        cols = img_per_row if rows > 1 else tile_num
+        return np.zeros((rows * tile_height, cols * tile_width, 3),
+                        dtype=np.uint8)
+
+    if tasks:
+        page_idx = 0
+        page = new_page(page_idx)
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(min(worker_num, len(tasks))) as pool:
+            # results come in tile order, a page is complete once a tile
+            # of a later page arrives
+            for results in pool.imap(_atlas_worker, tasks):
+                for tile_idx, tile in results:
+                    while tile_idx // page_size > page_idx:
+                        save_page(page, out_filename, page_idx, page_num)
+                        page_idx += 1
+                        page = new_page(page_idx)
+                    row_idx, col_idx = divmod(tile_idx % page_size,
+                                              img_per_row)
+                    page[row_idx * tile_height:
+                         (row_idx + 1) * tile_height,
+                         col_idx * tile_width:
+                         (col_idx + 1) * tile_width] = tile
+        while page_idx < page_num:
+            save_page(page, out_filename, page_idx, page_num)
+            page_idx += 1
+            if page_idx < page_num:
+                page = new_page(page_idx)
+    with open(os.path.splitext(out_filename)[0] + '.json', 'w') as fout:
+        json.dump(dict(video=filename, tile_width=tile_width,
+                       tile_height=tile_height, tiles=index), fout)
+    return index
+
 
 if __name__ == '__main__':
-    annotation = Annotation('/home/kchen/data/youtube/selected/aOyzrlBnxFs.mp4.annotation')
-    annotated_frames = []
-    for i, bboxes in annotation.objects().items():
-        if len(bboxes) > 0:
-            annotated_frames.append(int(i))
-    annotated_frames.sort()
-    video2img('aOyzr.avi', 'tiger.png', frame_list=annotated_frames,
-              frame_interval=10, img_per_row=30, max_num=900)
+    parser = argparse.ArgumentParser(
+        description='contact sheet of the annotated tubes of a video')
+    parser.add_argument('video')
+    parser.add_argument('out_file', help='.png, .jpg or .pdf')
+    parser.add_argument('--annotation',
+                        help='default: <video>.annotation[.npz]')
+    parser.add_argument('--keyframe-interval', type=int, default=1,
+                        help='show every n-th keyframe, 0 for none')
+    parser.add_argument('--mode', choices=['crop', 'overlay'],
+                        default='crop')
+    parser.add_argument('-j', '--workers', type=int)
+    parser.add_argument('--tile-width', type=int, default=160)
+    parser.add_argument('--tile-height', type=int, default=120)
+    parser.add_argument('--img-per-row', type=int, default=20)
+    parser.add_argument('--rows-per-page', type=int, default=50)
+    args = parser.parse_args()
+    annotation_file = args.annotation
+    if annotation_file is None:
+        annotation_file = args.video + '.annotation'
+        if os.path.isfile(annotation_file + '.npz'):
+            annotation_file += '.npz'
+    annotation_atlas(args.video, Annotation(annotation_file), args.out_file,
+                     args.keyframe_interval, args.mode, args.workers,
+                     args.tile_width, args.tile_height, args.img_per_row,
+                     args.rows_per_page)
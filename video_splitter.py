@@ -1,57 +1,267 @@
 #!/usr/bin/env python3
 
+import argparse
+import copy
 import os
 import json
+import multiprocessing
+import shutil
 import subprocess
+import time
 
 import ckutils
+import cv2
+import numpy as np
+
+
+def read_small_frames(filename, start, end=None, size=(64, 36),
+                      batch_size=256):
+    """decode frames [start, end) (0-based, until the last frame if end is
+    None) and yield batches of downsampled grayscale frames as arrays of
+    shape (n, h, w)
+    """
+    cap = cv2.VideoCapture(filename)
+    if start > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+    batch = np.empty((batch_size, size[1], size[0]), dtype=np.uint8)
+    n = 0
+    frame_idx = start
+    while end is None or frame_idx < end:
+        ret, img = cap.read()
+        if not ret:
+            break
+        frame_idx += 1
+        small = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+        batch[n] = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        n += 1
+        if n == batch_size:
+            yield batch
+            batch = np.empty_like(batch)
+            n = 0
+    if n > 0:
+        yield batch[:n]
+    cap.release()
+
+
+def frame_diffs(frames, method='sad', bins=16):
+    """differences in [0, 1] between consecutive frames of a batch
+
+    - sad: mean absolute difference of the pixels
+    - hist: half the L1 distance between normalized grayscale histograms
+    """
+    if method == 'sad':
+        diffs = np.abs(np.diff(frames.astype(np.int16), axis=0))
+        return diffs.reshape(diffs.shape[0], -1).mean(axis=1) / 255.0
+    n = frames.shape[0]
+    pixels = frames.reshape(n, -1)
+    idxes = (pixels.astype(np.int32) * bins >> 8) + \
+        (np.arange(n) * bins)[:, None]
+    hists = np.bincount(idxes.ravel(), minlength=n * bins).reshape(n, bins)
+    hists = hists / float(pixels.shape[1])
+    return np.abs(np.diff(hists, axis=0)).sum(axis=1) / 2.0
+
+
+def detect_chunk(args):
+    """0-based boundaries in the frames [start, end) of a video"""
+    filename, start, end, thr, method, size = args
+    boundaries = []
+    # the frame before the chunk is decoded to compare the first one, the
+    # first frame of a batch is compared with the last one of the previous
+    first = max(start - 1, 0)
+    pos = first
+    for batch in read_small_frames(filename, first, end, size):
+        if pos > first:
+            batch = np.concatenate((last[None], batch))
+            pos -= 1
+        diffs = frame_diffs(batch, method)
+        for idx in np.flatnonzero(diffs > thr).tolist():
+            if pos + idx + 1 >= start:
+                boundaries.append(pos + idx + 1)
+        pos += batch.shape[0]
+        last = batch[-1]
+    return boundaries
+
+
+def video_info(filename):
+    cap = cv2.VideoCapture(filename)
+    fps = int(round(cap.get(cv2.CAP_PROP_FPS)))
+    frame_num = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    return fps, frame_num
 
 
 class VideoSplitter(object):
+    """split videos into scenes
+
+    Scenes are detected in-process by comparing downsampled frames
+    (method 'sad' or 'hist'), optionally splitting a long video into
+    `chunk_num` chunks decoded in parallel, or with ffprobe's scene filter
+    (method 'ffprobe'). The sections are cached in <video>.cfg together
+    with the size and mtime of the video, the cache is used as long as the
+    video does not change.
+    """
 
-    def __init__(self, thr=0.15):
+    def __init__(self, thr=0.15, method='sad', chunk_num=1, size=(64, 36),
+                 min_chunk_size=500):
         self.thr = thr
-        pass
+        self.method = method
+        self.chunk_num = chunk_num
+        self.size = size
+        self.min_chunk_size = min_chunk_size
 
-    def split(self, filename, fps=None, frame_num=None, save=True):
-        if fps is None or frame_num is None:
-            import cv2
-            cap = cv2.VideoCapture(filename)
-            fps = int(round(cap.get(cv2.CAP_PROP_FPS)))
-            frame_num = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    def load_config(self, filename):
+        """cached sections of an unchanged video, None if there are none"""
         config_file = filename + '.cfg'
-        if os.path.isfile(config_file):
+        if not os.path.isfile(config_file):
+            return None
+        try:
             with open(config_file, 'r') as fin:
                 config = json.load(fin)
-            return config['sections']
-        scene_ps = subprocess.Popen(
-            ('ffprobe', '-show_frames', '-of', 'compact=p=0', '-f', 'lavfi',
-             'movie={},select=gt(scene\,{})'.format(filename, self.thr)),
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT)
-        output = scene_ps.stdout.read().decode('utf-8')
-        boundaries = []
-        for line in output.split('\n')[15: -1]:
-            time_point = float(line.split('|')[4].split('=')[-1])
-            boundaries.append(int(round(time_point * fps)))
-        sections = [[0, boundaries[0]]]
-        for bd in boundaries[1:]:
-            start = sections[-1][1] + 1
-            if bd - start == 1:
-                sections[-1][1] = bd
-            else:
-                sections.append([start, bd - 1])
-        sections.append((sections[-1][1] + 1, frame_num))
+        except ValueError:
+            return None
+        # configs written before the stat was stored are trusted
+        stat = os.stat(filename)
+        if (config.get('size', stat.st_size) != stat.st_size or
+                config.get('mtime', stat.st_mtime) != stat.st_mtime):
+            return None
+        return config['sections']
+
+    def save_config(self, filename, sections):
+        stat = os.stat(filename)
+        config = dict(sections=sections, size=stat.st_size,
+                      mtime=stat.st_mtime)
+        config_file = filename + '.cfg'
+        tmp_file = config_file + '.tmp'
+        with open(tmp_file, 'w') as fout:
+            json.dump(config, fout)
+        os.replace(tmp_file, config_file)
+
+    def split(self, filename, fps=None, frame_num=None, save=True):
+        sections = self.load_config(filename)
+        if sections is not None:
+            return sections
+        if fps is None or frame_num is None:
+            fps, frame_num = video_info(filename)
+        if self.method == 'ffprobe' and shutil.which('ffprobe') is not None:
+            boundaries = self.probe_boundaries(filename, fps)
+        else:
+            boundaries = self.detect_boundaries(filename, frame_num)
+        sections = self.to_sections(boundaries, frame_num)
         if save:
-            config = dict(sections=sections)
-            with open(config_file, 'w') as fout:
-                json.dump(config, fout)
+            self.save_config(filename, sections)
+        return sections
+
+    def probe_boundaries(self, filename, fps):
+        output = subprocess.check_output(
+            ('ffprobe', '-v', 'error', '-show_entries', 'frame=pts_time',
+             '-of', 'compact=p=0', '-f', 'lavfi',
+             'movie={},select=gt(scene\\,{})'.format(filename, self.thr)))
+        boundaries = []
+        for line in output.decode('utf-8').split('\n'):
+            fields = dict(item.split('=', 1) for item in line.split('|')
+                          if '=' in item)
+            if fields.get('pts_time', 'N/A') == 'N/A':
+                continue
+            boundaries.append(int(round(float(fields['pts_time']) * fps)))
+        return boundaries
+
+    def detect_boundaries(self, filename, frame_num=None):
+        """find scene cuts by comparing consecutive downsampled grayscale
+        frames with the threshold, chunks of the video are processed in
+        parallel if chunk_num > 1
+        """
+        if frame_num is None:
+            _, frame_num = video_info(filename)
+        chunk_num = max(
+            min(self.chunk_num, frame_num // self.min_chunk_size), 1)
+        bounds = [int(round(i * frame_num / chunk_num))
+                  for i in range(chunk_num)]
+        # the last chunk reads until the end in case the count is wrong
+        bounds.append(None)
+        tasks = [(filename, bounds[i], bounds[i + 1], self.thr, self.method,
+                  self.size) for i in range(chunk_num)]
+        if chunk_num == 1:
+            return detect_chunk(tasks[0])
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(chunk_num) as pool:
+            results = pool.map(detect_chunk, tasks)
+        return sorted(set(bd for boundaries in results for bd in boundaries))
+
+    def to_sections(self, boundaries, frame_num):
+        """[first, last] 0-based frames of every scene, a boundary is the
+        first frame of a scene and scenes of one frame are merged
+        """
+        sections = []
+        start = 0
+        for bd in boundaries:
+            if bd - start <= 1:
+                continue
+            sections.append([start, bd - 1])
+            start = bd
+        sections.append([start, frame_num - 1])
         return sections
 
+
+def _split_worker(args):
+    filename, splitter = args
+    start = time.time()
+    fps, frame_num = video_info(filename)
+    sections = splitter.split(filename, fps, frame_num)
+    return filename, len(sections), frame_num, time.time() - start
+
+
+def split_dir(video_dir, worker_num=None, exts=('mp4', 'mkv'),
+              splitter=None):
+    """split all videos of a directory with at most worker_num videos
+    decoded at the same time, videos with an up-to-date .cfg are skipped
+
+    Every video is split in a single process, the pool workers are
+    daemonic and cannot start a pool for the chunks of a video.
+    """
+    if splitter is None:
+        splitter = VideoSplitter()
+    else:
+        splitter = copy.copy(splitter)
+        splitter.chunk_num = 1
+    filenames = [os.path.join(video_dir, filename)
+                 for filename in ckutils.scandir(video_dir, list(exts))]
+    todo = [filename for filename in filenames
+            if splitter.load_config(filename) is None]
+    print('{} videos to split, {} up to date'.format(
+        len(todo), len(filenames) - len(todo)))
+    if not todo:
+        return
+    if worker_num is None:
+        worker_num = multiprocessing.cpu_count()
+    start = time.time()
+    total_frames = 0
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(min(worker_num, len(todo))) as pool:
+        for i, (filename, section_num, frame_num, seconds) in enumerate(
+                pool.imap_unordered(_split_worker,
+                                    [(filename, splitter)
+                                     for filename in todo])):
+            total_frames += frame_num
+            print('[{}/{}] {}: {} sections, {:.1f}s, {:.1f} fps'.format(
+                i + 1, len(todo), os.path.basename(filename), section_num,
+                seconds, frame_num / seconds if seconds > 0 else 0.0))
+    seconds = time.time() - start
+    print('split {} videos, {} frames in {:.1f}s, {:.1f} fps'.format(
+        len(todo), total_frames, seconds,
+        total_frames / seconds if seconds > 0 else 0.0))
+
+
 if __name__ == '__main__':
-    vs = VideoSplitter()
-    video_dir = '/home/kchen/data/youtube/selected/'
-    for filename in ckutils.scandir(video_dir, ['mp4', 'mkv']):
-        print(filename)
-        sections = vs.split(video_dir + filename)
-        print(len(sections), 'sections')
+    parser = argparse.ArgumentParser(
+        description='split the videos of a directory into scenes')
+    parser.add_argument('video_dir')
+    parser.add_argument('-j', '--workers', type=int,
+                        help='number of videos decoded at the same time, '
+                        'default: number of cpus')
+    parser.add_argument('--thr', type=float, default=0.15)
+    parser.add_argument('--method', default='sad',
+                        choices=['sad', 'hist', 'ffprobe'])
+    parser.add_argument('--exts', nargs='+', default=['mp4', 'mkv'])
+    args = parser.parse_args()
+    split_dir(args.video_dir, args.workers, args.exts,
+              VideoSplitter(args.thr, args.method))
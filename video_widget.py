@@ -8,7 +8,9 @@ from annotation import Annotation
 from bbox import BoundingBox
 from ckutils.cv import *
 from image_label import ImageLabel
-from tracker import Tracker
+from multi_tracker import MultiTracker
+from subtitle import Subtitle, find_subtitle
+from tracker import TrackWorker
 from video import *
 
 
@@ -18,25 +20,47 @@ class VideoWidget(QWidget):
     tube_annotated = pyqtSignal(dict)
     annotation_loaded = pyqtSignal(list)
     export_progress_updated = pyqtSignal(int)
+    export_finished = pyqtSignal(dict)
+    tubes_propagated = pyqtSignal(dict)
 
     def __init__(self, parent=None, with_filename=True, with_slider=True,
-                 cache_capacity=500, max_fps=0):
+                 cache_capacity=500, max_fps=0, display_cache_bytes=512 << 20):
         super(VideoWidget, self).__init__(parent)
         self.with_filename = with_filename
         self.with_slider = with_slider
-        self.video = Video(cache_capacity=cache_capacity, max_fps=max_fps)
-        self.annotation = Annotation()
+        self.video = Video(cache_capacity=cache_capacity, max_fps=max_fps,
+                           display_cache_bytes=display_cache_bytes)
+        # mutations are journaled by a background thread, so there is no
+        # need to save the annotation file after every change
+        self.annotation = Annotation(journal=True)
         self.tube_id = 0
         self.tracker = None
         self.sim_thr = 0.9
+        # boxes tracked with a lower similarity are flagged for review and
+        # stop the auto-advance
+        self.review_thr = 0.95
+        # frames flagged by propagating all open tubes
+        self.review_frames = set()
+        # frames tracked ahead of the cursor by the tracking worker
+        self.look_ahead = 30
+        # track on a downscaled pyramid level chosen from the box size
+        self.track_downscale = True
+        self.track_grayscale = False
+        # frames and processes used to propagate all open tubes at once
+        self.propagate_num = 300
+        self.track_workers = os.cpu_count()
+        self.export_workers = os.cpu_count()
         self.init_ui()
         self.installEventFilter(self)
         if self.with_slider:
             self.slider.sliderReleased.connect(self.on_slider_released)
         self.label_frame.bbox_added.connect(self.set_tracker)
         self.label_frame.bbox_deleted.connect(self.del_tracker)
+        self.label_frame.resized.connect(self.video.set_display_size)
         self.video.frame_updated.connect(self.update_frame)
         self.video.export_progress_updated.connect(self.update_export_progress)
+        self.video.export_finished.connect(self.export_finished)
+        self.tubes_propagated.connect(self.on_tubes_propagated)
 
     def init_ui(self):
         self.vbox_layout = QVBoxLayout()
@@ -95,24 +119,37 @@ class VideoWidget(QWidget):
             elif key == Qt.Key_Space:
                 self.pause()
                 return True
+            elif key == Qt.Key_I:
+                self.interpolate_tube()
+                return True
+            elif key == Qt.Key_P:
+                self.propagate_tubes()
+                return True
+            elif key == Qt.Key_BracketLeft:
+                self.jump_to_prev_cut()
+                return True
+            elif key == Qt.Key_BracketRight:
+                self.jump_to_next_cut()
+                return True
+            elif key == Qt.Key_N:
+                self.jump_to_next_review()
+                return True
         return False
 
     def frame_forward(self):
-        if self.tracker is not None:
-            ori_hist = color_hist(self.tracker.init_region, 16)
-            if self.cursor() >= self.annotation.tube_end(self.tube_id):
-                self.last_keyframe = self.cursor()
+        # at the tracking front, advance over up to 10 frames which the
+        # tracking worker has already propagated
+        at_front = (self.tracker is not None and
+                    self.cursor() >= self.tracker.reviewed)
+        if at_front:
+            self.last_keyframe = self.cursor()
         cnt = 0
         while cnt < 10:
             frame = self.video.frame_forward()
             self.update_frame(frame)
-            if (self.tracker is None or
-                    self.cursor() < self.annotation.tube_end(self.tube_id)):
-                break
-            bbox = self.tracker.bbox
-            hist = color_hist(
-                frame.raw_img[bbox.left: bbox.right, bbox.top: bbox.bottom], 16)
-            if compare_hist(hist, ori_hist) < self.sim_thr:
+            # stop at frames flagged for review
+            if (not at_front or self.needs_review(self.cursor()) or
+                    not self.tracker.is_tracked(self.cursor() + 1)):
                 break
             cnt += 1
 
@@ -134,6 +171,40 @@ class VideoWidget(QWidget):
         frame = self.video.jump_to_frame(frame_id)
         self.update_frame(frame)
 
+    def jump_to_prev_cut(self):
+        if self.video.scene_index is None:
+            return
+        frame_id = self.video.scene_index.prev_cut(self.cursor())
+        self.jump_to_frame(frame_id if frame_id is not None else 1)
+
+    def jump_to_next_cut(self):
+        if self.video.scene_index is None:
+            return
+        frame_id = self.video.scene_index.next_cut(self.cursor())
+        if frame_id is not None:
+            self.jump_to_frame(frame_id)
+
+    def needs_review(self, frame_id):
+        if frame_id in self.review_frames:
+            return True
+        return (self.tracker is not None and
+                self.tracker.is_low_confidence(frame_id))
+
+    def jump_to_next_review(self):
+        """jump to the next frame with a low confidence tracked box"""
+        frames = set(self.review_frames)
+        if self.tracker is not None:
+            frames.update(self.tracker.low_confidence())
+        frames = [frame_id for frame_id in frames if frame_id > self.cursor()]
+        if frames:
+            self.jump_to_frame(min(frames))
+
+    def next_cut(self):
+        """the first frame of the next scene, None if unknown"""
+        if self.video.scene_index is None:
+            return None
+        return self.video.scene_index.next_cut(self.cursor())
+
     def status(self):
         return self.video.status
 
@@ -156,17 +227,65 @@ class VideoWidget(QWidget):
             self.label_frame.is_new_tube = True
 
     def clear_tracker(self):
+        """stop the tracking worker and drop the boxes it appended to the
+        tube beyond the furthest displayed frame
+        """
+        if self.tracker is None:
+            return
+        self.tracker.stop()
+        tube = self.annotation.tube(self.tracker.tube_id)
+        if tube is not None and tube.end >= self.tracker.appended_from:
+            self.annotation.del_later_bboxes(self.tracker.tube_id,
+                                             self.tracker.appended_from)
         self.tracker = None
 
     def reset_tube_id(self):
         self.tube_id = 0
 
-    def track(self, frame):
-        frame_rect = BoundingBox(None, 0, 0, 0,
-                                 self.video.width, self.video.height)
-        bbox, score = self.tracker.update(frame)
-        bbox = bbox.intersected(frame_rect)
-        return bbox
+    def interpolate_tube(self, mode='linear'):
+        """re-interpolate the current tube from its keyframes"""
+        if self.annotation.tube(self.tube_id) is None:
+            return
+        self.annotation.interpolate_keyframes(self.tube_id, mode)
+        self.update_frame(self.current_frame())
+
+    def propagate_tubes(self):
+        """track all open tubes from the current frame in the background"""
+        if self.status() == VideoStatus.not_loaded:
+            return
+        self.clear_tracker()
+        # do not track across a scene cut
+        frame_num = self.propagate_num
+        next_cut = self.next_cut()
+        if next_cut is not None:
+            frame_num = min(frame_num, next_cut - self.cursor() - 1)
+        multi_tracker = MultiTracker(self.video.filename, self.track_workers,
+                                     sim_thr=self.sim_thr,
+                                     downscale=self.track_downscale,
+                                     grayscale=self.track_grayscale)
+
+        def run():
+            try:
+                last_frames = multi_tracker.propagate(self.annotation,
+                                                      self.cursor(), frame_num)
+            except RuntimeError as err:
+                self.tubes_propagated.emit(dict(
+                    last_frames=dict(), low_confidence=dict(),
+                    error=str(err)))
+                return
+            self.tubes_propagated.emit(dict(
+                last_frames=last_frames,
+                low_confidence=multi_tracker.low_confidence(self.review_thr)))
+
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+
+    @pyqtSlot(dict)
+    def on_tubes_propagated(self, result):
+        for frames in result['low_confidence'].values():
+            self.review_frames.update(frames)
+        self.update_frame(self.current_frame())
 
     def adjust_track_bboxes(self, bbox):
         self.annotation.interpolate(self.tube_id, bbox, self.last_keyframe,
@@ -174,16 +293,13 @@ class VideoWidget(QWidget):
 
     @pyqtSlot(VideoFrame)
     def update_frame(self, frame):
-        # get bounding boxes of current tube and other tubes
+        # get bounding boxes of current tube and other tubes, the current
+        # tube is propagated by the tracking worker
+        if self.tracker is not None:
+            self.tracker.set_cursor(self.cursor())
         bboxes = dict()
-        if (self.tracker is not None and self.video.is_forward() and
-                self.cursor() > self.annotation.tube_end(self.tube_id)):
-            bboxes['current_tube'] = self.track(frame)
-            self.annotation.set_bbox(self.tube_id, self.cursor(),
-                                     bboxes['current_tube'])
-        else:
-            bboxes['current_tube'] = self.annotation.get_bbox(
-                self.tube_id, self.cursor())
+        bboxes['current_tube'] = self.annotation.get_bbox(
+            self.tube_id, self.cursor())
         bboxes['other_tubes'] = self.annotation.get_bboxes(
             self.cursor(), self.tube_id)
         # show the frame and corresponding bounding boxes
@@ -198,17 +314,27 @@ class VideoWidget(QWidget):
 
     @pyqtSlot(BoundingBox)
     def set_tracker(self, bbox):
-        if self.tracker is not None and self.cursor() > self.last_keyframe + 1:
-            self.adjust_track_bboxes(bbox)
-        self.tracker = Tracker()
-        self.tracker.start_track(self.current_frame(), bbox)
+        if self.tracker is not None and self.tracker.tube_id == self.tube_id:
+            self.tracker.stop()
+            if self.cursor() > self.last_keyframe + 1:
+                self.adjust_track_bboxes(bbox)
+        # only the boxes the previous worker appended are dropped, the rest
+        # of a re-drawn tube is kept
+        self.clear_tracker()
         self.annotation.set_bbox(self.tube_id, self.cursor(), bbox)
+        self.tracker = TrackWorker(self.video.filename, self.annotation,
+                                   self.tube_id, self.look_ahead,
+                                   self.sim_thr,
+                                   downscale=self.track_downscale,
+                                   grayscale=self.track_grayscale,
+                                   stop_frame=self.next_cut(),
+                                   review_thr=self.review_thr)
+        self.tracker.start(self.cursor(), bbox)
 
     @pyqtSlot()
     def del_tracker(self):
         self.clear_tracker()
         self.annotation.del_later_bboxes(self.tube_id, self.cursor())
-        self.annotation.save()
         tube_info = self.annotation.tube(self.tube_id).to_dict(with_bboxes=False)
         self.tube_annotated.emit(tube_info)
         self.reset_tube_id()
@@ -229,12 +355,10 @@ class VideoWidget(QWidget):
         if self.tube_id == tube_id:
             self.tube_id = 0
         self.annotation.del_tube(tube_id)
-        self.annotation.save()
 
     @pyqtSlot(int, str)
     def change_tube_label(self, tube_id, label):
-        self.annotation.tubes[tube_id].label = label
-        self.annotation.save()
+        self.annotation.set_label(tube_id, label)
 
     @pyqtSlot(str)
     def update_bbox_label(self, label):
@@ -247,25 +371,51 @@ class VideoWidget(QWidget):
             'Videos (*.mp4 *.avi *.mkv *.flv *.m4v)')
         if not self.filename:
             return
+        self.clear_tracker()
+        self.review_frames.clear()
         if self.with_filename:
             self.label_filename.setText(os.path.basename(self.filename))
         if self.with_slider:
             self.slider.setEnabled(True)
         self.video.load(self.filename)
-        self.annotation.load(self.filename + '.annotation')
+        annotation_file = self.filename + '.annotation'
+        if os.path.isfile(annotation_file + '.npz'):
+            annotation_file += '.npz'
+        self.annotation.load(annotation_file)
         self.annotation_loaded.emit(self.annotation.get_brief_info())
         self.jump_to_frame(1)
 
+    def load_subtitle(self):
+        """the subtitle next to the video (<name>.srt or <name>.vtt)"""
+        subtitle_file = find_subtitle(self.video.filename)
+        if subtitle_file is None:
+            return None
+        try:
+            return Subtitle(subtitle_file)
+        except (OSError, ValueError) as err:
+            QMessageBox.warning(self, 'Subtitle',
+                                'Cannot load {}: {}'.format(subtitle_file,
+                                                            err))
+            return None
+
     @pyqtSlot()
     def export_video(self):
         filename, _ = QFileDialog.getSaveFileName(
             self, 'Export video', './', 'Videos (*.avi)')
+        if not filename:
+            return
         t = threading.Thread(target=self.video.export,
                              kwargs=dict(out_file=filename,
-                                         annotation=self.annotation))
+                                         annotation=self.annotation,
+                                         worker_num=self.export_workers,
+                                         subtitle=self.load_subtitle()))
         t.daemon = True
         t.start()
 
+    @pyqtSlot()
+    def cancel_export(self):
+        self.video.cancel_export()
+
     @pyqtSlot(int)
     def update_export_progress(self, progress):
         self.export_progress_updated.emit(progress)